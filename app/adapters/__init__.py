@@ -1,3 +1,5 @@
+from . import assets
 from . import aws_s3
 from . import database
+from . import upstream
 from . import webdriver
@@ -0,0 +1,40 @@
+import functools
+import os
+
+# NOTE: keep in sync with `ASSETS_VERSION` in scripts/fetch-assets.sh
+ASSETS_VERSION = 5
+ASSETS_DIR = os.path.join("/srv/assets", f"v{ASSETS_VERSION}")
+
+UNKNOWN_COUNTRY_CODE = "xx"
+
+
+def get_assets_base_url() -> str:
+    return f"file://{ASSETS_DIR}"
+
+
+def get_font_path(file_name: str) -> str:
+    return os.path.join(ASSETS_DIR, "fonts", file_name)
+
+
+@functools.cache
+def get_fonts_digest() -> str | None:
+    """Get the sha256 sums `fetch-assets.sh` recorded for the fonts, if any."""
+    try:
+        with open(os.path.join(ASSETS_DIR, "fonts", "SHA256SUMS")) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def get_flag_path(country_code: str, raster: bool = False) -> str:
+    flags_dir = os.path.join(ASSETS_DIR, "flags")
+    ext = "svg"
+    if raster:
+        flags_dir = os.path.join(flags_dir, "png")
+        ext = "png"
+
+    flag_path = os.path.join(flags_dir, f"{country_code.lower()}.{ext}")
+    if not os.path.exists(flag_path):
+        flag_path = os.path.join(flags_dir, f"{UNKNOWN_COUNTRY_CODE}.{ext}")
+
+    return flag_path
@@ -1,5 +1,7 @@
 import logging
 
+from botocore.exceptions import ClientError
+
 from app import state
 from app.common import settings
 
@@ -10,6 +12,15 @@ async def get_object_data(key: str) -> bytes | None:
             Bucket=settings.AWS_S3_BUCKET_NAME,
             Key=key,
         )
+    except ClientError as exc:
+        # a missing object is expected, e.g. on a thumbnail cache miss
+        if exc.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+            logging.warning(
+                "Failed to get object data from S3",
+                exc_info=True,
+                extra={"object_key": key},
+            )
+        return None
     except Exception:
         logging.warning(
             "Failed to get object data from S3",
@@ -21,7 +32,7 @@ async def get_object_data(key: str) -> bytes | None:
     return await s3_object["Body"].read()
 
 
-async def save_object_data(key: str, data: bytes) -> None:
+async def save_object_data(key: str, data: bytes) -> bool:
     try:
         await state.s3_client.put_object(
             Bucket=settings.AWS_S3_BUCKET_NAME,
@@ -34,4 +45,6 @@ async def save_object_data(key: str, data: bytes) -> None:
             exc_info=True,
             extra={"object_key": key},
         )
-        return None
+        return False
+
+    return True
@@ -0,0 +1,524 @@
+import asyncio
+import collections
+import importlib.util
+import logging
+import random
+import time
+import typing
+
+import httpx
+
+from app.common import settings
+
+Service = typing.Literal[
+    "api",
+    "avatars",
+    "beatmaps",
+    "performance",
+    "scores",
+    "website",
+]
+
+USER_AGENT = "akatsuki/management-bot"
+
+# http/2 needs the optional `h2` package, and is only negotiated over tls
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# responses which mean the service may well succeed if asked again
+RETRYABLE_STATUS_CODES = frozenset((429, 502, 503, 504))
+
+RETRY_BACKOFF_BASE = 0.1
+RETRY_BACKOFF_MAX = 2.0
+
+# requests still waiting after this percentile of latency are hedged
+HEDGE_PERCENTILE = 0.95
+
+
+class ServiceConfig(typing.TypedDict):
+    base_url: str
+    # connections are pooled per service, so one slow service can only
+    # exhaust its own connections, rather than everyone's.
+    max_connections: int
+    max_keepalive_connections: int
+    keepalive_expiry: float
+    connect_timeout: float
+    read_timeout: float
+    # methods which are safe to retry against this service
+    retry_methods: frozenset[str]
+    max_retries: int
+    # consecutive failures before requests to the service fail fast, and
+    # how long until a probe request is let through to check for recovery
+    failure_threshold: int
+    reset_timeout: float
+    # whether slow GET requests made with `hedged_get` are hedged
+    hedge_requests: bool
+
+
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+
+SERVICE_CONFIGS: dict[Service, ServiceConfig] = {
+    "api": {
+        "base_url": settings.APP_API_URL,
+        "max_connections": 20,
+        "max_keepalive_connections": 10,
+        "keepalive_expiry": 30,
+        "connect_timeout": 3,
+        "read_timeout": 10,
+        "retry_methods": IDEMPOTENT_METHODS,
+        "max_retries": 2,
+        "failure_threshold": 5,
+        "reset_timeout": 30,
+        "hedge_requests": True,
+    },
+    "avatars": {
+        "base_url": "https://a.akatsuki.gg",
+        "max_connections": 10,
+        "max_keepalive_connections": 5,
+        "keepalive_expiry": 30,
+        "connect_timeout": 3,
+        "read_timeout": 10,
+        "retry_methods": IDEMPOTENT_METHODS,
+        "max_retries": 2,
+        "failure_threshold": 5,
+        "reset_timeout": 30,
+        "hedge_requests": False,
+    },
+    "beatmaps": {
+        "base_url": settings.APP_BEATMAPS_SERVICE_URL,
+        "max_connections": 20,
+        "max_keepalive_connections": 10,
+        "keepalive_expiry": 30,
+        "connect_timeout": 3,
+        # .osz files can be large, though this bounds time between chunks
+        "read_timeout": 30,
+        "retry_methods": IDEMPOTENT_METHODS,
+        "max_retries": 2,
+        "failure_threshold": 5,
+        "reset_timeout": 30,
+        "hedge_requests": True,
+    },
+    "performance": {
+        "base_url": settings.APP_PERFORMANCE_URL,
+        "max_connections": 10,
+        "max_keepalive_connections": 5,
+        "keepalive_expiry": 30,
+        "connect_timeout": 3,
+        "read_timeout": 30,
+        # calculations are posted, but have no side effects
+        "retry_methods": IDEMPOTENT_METHODS | {"POST"},
+        "max_retries": 2,
+        "failure_threshold": 5,
+        "reset_timeout": 30,
+        "hedge_requests": False,
+    },
+    "scores": {
+        "base_url": settings.APP_SCORE_SERVICE_URL,
+        "max_connections": 10,
+        "max_keepalive_connections": 5,
+        "keepalive_expiry": 30,
+        "connect_timeout": 3,
+        "read_timeout": 30,
+        "retry_methods": IDEMPOTENT_METHODS,
+        "max_retries": 2,
+        "failure_threshold": 5,
+        "reset_timeout": 30,
+        "hedge_requests": False,
+    },
+    "website": {
+        "base_url": "https://akatsuki.gg",
+        "max_connections": 10,
+        "max_keepalive_connections": 5,
+        "keepalive_expiry": 30,
+        "connect_timeout": 3,
+        "read_timeout": 10,
+        "retry_methods": IDEMPOTENT_METHODS,
+        "max_retries": 2,
+        "failure_threshold": 5,
+        "reset_timeout": 30,
+        "hedge_requests": False,
+    },
+}
+
+
+class RetryBudget:
+    """Limits retries to a fraction of requests made, so that retries can't
+    multiply the load on a service which is already struggling.
+
+    Every request deposits `ratio` tokens, and every retry withdraws one.
+    """
+
+    def __init__(self, ratio: float = 0.2, max_tokens: float = 10) -> None:
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+
+    def record_request(self) -> None:
+        self._tokens = min(self._tokens + self.ratio, self.max_tokens)
+
+    def try_withdraw(self) -> bool:
+        if self._tokens < 1:
+            return False
+
+        self._tokens -= 1
+        return True
+
+
+class RetryTransport(httpx.AsyncBaseTransport):
+    """Retries failed requests with jittered exponential backoff.
+
+    Only requests with a method in `retry_methods` are retried, when they
+    couldn't connect, timed out, or got a response in `RETRYABLE_STATUS_CODES`.
+    """
+
+    def __init__(
+        self,
+        service: Service,
+        transport: httpx.AsyncBaseTransport,
+        retry_methods: frozenset[str],
+        max_retries: int,
+    ) -> None:
+        self.service = service
+        self.retry_methods = retry_methods
+        self.max_retries = max_retries
+        self.retry_budget = RetryBudget()
+
+        self._transport = transport
+
+    def _should_retry(self, request: httpx.Request, attempt: int) -> bool:
+        return (
+            request.method in self.retry_methods
+            and attempt < self.max_retries
+            and self.retry_budget.try_withdraw()
+        )
+
+    async def _backoff(self, attempt: int) -> None:
+        # "full jitter", so that retrying clients spread out, not synchronise
+        backoff = min(RETRY_BACKOFF_BASE * 2**attempt, RETRY_BACKOFF_MAX)
+        await asyncio.sleep(random.uniform(0, backoff))
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.retry_budget.record_request()
+
+        attempt = 0
+        while True:
+            try:
+                response = await self._transport.handle_async_request(request)
+            except (httpx.ConnectError, httpx.TimeoutException) as exc:
+                if not self._should_retry(request, attempt):
+                    raise
+
+                logging.warning(
+                    "Retrying failed upstream request",
+                    extra={
+                        "service": self.service,
+                        "url": str(request.url),
+                        "attempt": attempt + 1,
+                        "error": repr(exc),
+                    },
+                )
+            else:
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    return response
+
+                if not self._should_retry(request, attempt):
+                    return response
+
+                await response.aclose()
+                logging.warning(
+                    "Retrying failed upstream request",
+                    extra={
+                        "service": self.service,
+                        "url": str(request.url),
+                        "attempt": attempt + 1,
+                        "status_code": response.status_code,
+                    },
+                )
+
+            await self._backoff(attempt)
+            attempt += 1
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class ServiceUnavailableError(httpx.TransportError):
+    """Raised instead of making a request while a service's circuit is open."""
+
+    def __init__(self, service: Service, request: httpx.Request) -> None:
+        super().__init__(f"The {service} service is unavailable", request=request)
+        self.service = service
+
+
+CircuitState = typing.Literal["closed", "open", "half_open"]
+
+
+class CircuitBreaker:
+    """Fails requests fast while a service keeps failing, rather than having
+    every caller wait on timeouts.
+
+    After `failure_threshold` consecutive failures the circuit opens. Once
+    `reset_timeout` seconds have passed, a single probe request is let through
+    (half-open): if it succeeds the circuit closes, otherwise it opens again.
+    """
+
+    def __init__(
+        self,
+        service: Service,
+        failure_threshold: int,
+        reset_timeout: float,
+    ) -> None:
+        self.service = service
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state: CircuitState = "closed"
+
+        self._failures = 0
+        self._opened_at = 0.0
+
+    def allow_request(self) -> bool:
+        if self.state == "closed":
+            return True
+
+        if self.state == "half_open":
+            # only one probe request at a time
+            return False
+
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            return False
+
+        self.state = "half_open"
+        return True
+
+    def record_success(self) -> None:
+        if self.state != "closed":
+            logging.info(
+                "Upstream service recovered, closing circuit",
+                extra={"service": self.service},
+            )
+
+        self.state = "closed"
+        self._failures = 0
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self.state == "closed" and self._failures < self.failure_threshold:
+            return
+
+        if self.state == "closed":
+            logging.warning(
+                "Upstream service is failing, opening circuit",
+                extra={"service": self.service, "failures": self._failures},
+            )
+
+        self.state = "open"
+        self._opened_at = time.monotonic()
+
+    def record_cancelled(self) -> None:
+        # a cancelled probe says nothing about the service, so let another
+        # request probe it straight away
+        if self.state == "half_open":
+            self.state = "open"
+
+
+class LatencyTracker:
+    """Tracks the latencies of a service's most recent successful responses."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20) -> None:
+        self.min_samples = min_samples
+        self._latencies: collections.deque[float] = collections.deque(maxlen=window)
+
+    def record(self, latency: float) -> None:
+        self._latencies.append(latency)
+
+    def percentile(self, percentile: float) -> float | None:
+        if len(self._latencies) < self.min_samples:
+            return None
+
+        latencies = sorted(self._latencies)
+        return latencies[min(int(len(latencies) * percentile), len(latencies) - 1)]
+
+
+class ServiceTransport(httpx.AsyncBaseTransport):
+    """Guards requests to a service with its circuit breaker, and tracks the
+    latencies of its responses.
+
+    Transport errors & 5xx responses (after any retries) count as failures.
+    """
+
+    def __init__(
+        self,
+        service: Service,
+        transport: httpx.AsyncBaseTransport,
+        circuit_breaker: CircuitBreaker,
+        latency_tracker: LatencyTracker,
+    ) -> None:
+        self.service = service
+        self.circuit_breaker = circuit_breaker
+        self.latency_tracker = latency_tracker
+
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if not self.circuit_breaker.allow_request():
+            raise ServiceUnavailableError(self.service, request)
+
+        start_time = time.perf_counter()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except httpx.TransportError:
+            self.circuit_breaker.record_failure()
+            raise
+        except BaseException:
+            self.circuit_breaker.record_cancelled()
+            raise
+
+        if response.status_code >= 500:
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+            self.latency_tracker.record(time.perf_counter() - start_time)
+
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+_clients: dict[Service, httpx.AsyncClient] = {}
+_circuit_breakers: dict[Service, CircuitBreaker] = {}
+_latency_trackers: dict[Service, LatencyTracker] = {}
+
+# hedges are limited to a fraction of requests, like retries
+_hedge_budgets: dict[Service, RetryBudget] = {}
+
+
+def _create_client(service: Service) -> httpx.AsyncClient:
+    config = SERVICE_CONFIGS[service]
+    transport = httpx.AsyncHTTPTransport(
+        http2=HTTP2_AVAILABLE,
+        limits=httpx.Limits(
+            max_connections=config["max_connections"],
+            max_keepalive_connections=config["max_keepalive_connections"],
+            keepalive_expiry=config["keepalive_expiry"],
+        ),
+    )
+    return httpx.AsyncClient(
+        base_url=config["base_url"],
+        transport=ServiceTransport(
+            service,
+            RetryTransport(
+                service,
+                transport,
+                retry_methods=config["retry_methods"],
+                max_retries=config["max_retries"],
+            ),
+            circuit_breaker=_get_circuit_breaker(service),
+            latency_tracker=_get_latency_tracker(service),
+        ),
+        timeout=httpx.Timeout(
+            config["read_timeout"],
+            connect=config["connect_timeout"],
+            # bounds waiting for a free connection from the service's pool
+            pool=config["read_timeout"],
+        ),
+        follow_redirects=True,
+        headers={"User-Agent": USER_AGENT},
+    )
+
+
+def _get_circuit_breaker(service: Service) -> CircuitBreaker:
+    circuit_breaker = _circuit_breakers.get(service)
+    if circuit_breaker is None:
+        config = SERVICE_CONFIGS[service]
+        circuit_breaker = CircuitBreaker(
+            service,
+            failure_threshold=config["failure_threshold"],
+            reset_timeout=config["reset_timeout"],
+        )
+        _circuit_breakers[service] = circuit_breaker
+
+    return circuit_breaker
+
+
+def _get_latency_tracker(service: Service) -> LatencyTracker:
+    latency_tracker = _latency_trackers.get(service)
+    if latency_tracker is None:
+        latency_tracker = LatencyTracker()
+        _latency_trackers[service] = latency_tracker
+
+    return latency_tracker
+
+
+def get_client(service: Service) -> httpx.AsyncClient:
+    """Get the shared, pooled http client for an upstream service."""
+    client = _clients.get(service)
+    if client is None:
+        client = _create_client(service)
+        _clients[service] = client
+
+    return client
+
+
+def is_available(service: Service) -> bool:
+    """Whether requests to a service are currently being let through."""
+    return _get_circuit_breaker(service).state == "closed"
+
+
+def _get_hedge_delay(service: Service) -> float | None:
+    if not SERVICE_CONFIGS[service]["hedge_requests"] or not is_available(service):
+        return None
+
+    return _get_latency_tracker(service).percentile(HEDGE_PERCENTILE)
+
+
+async def hedged_get(
+    service: Service,
+    url: str,
+    **kwargs: typing.Any,
+) -> httpx.Response:
+    """Make an idempotent GET request to a service, hedging slow responses.
+
+    If no response has arrived within the service's p95 latency, an identical
+    request is sent alongside, and whichever succeeds first is used.
+    """
+    client = get_client(service)
+
+    hedge_budget = _hedge_budgets.setdefault(service, RetryBudget(ratio=0.1))
+    hedge_budget.record_request()
+
+    requests = {asyncio.create_task(client.get(url, **kwargs))}
+    try:
+        hedge_delay = _get_hedge_delay(service)
+        if hedge_delay is not None:
+            done, _ = await asyncio.wait(requests, timeout=hedge_delay)
+            if not done and hedge_budget.try_withdraw():
+                logging.info(
+                    "Hedging slow upstream request",
+                    extra={"service": service, "url": url, "hedge_delay": hedge_delay},
+                )
+                requests.add(asyncio.create_task(client.get(url, **kwargs)))
+
+        while True:
+            done, pending = await asyncio.wait(
+                requests,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+
+            if not pending:
+                # every request failed
+                return done.pop().result()
+
+            requests = pending
+    finally:
+        for task in requests:
+            task.cancel()
+
+
+async def close() -> None:
+    for client in _clients.values():
+        await client.aclose()
+
+    _clients.clear()
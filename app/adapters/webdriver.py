@@ -1,34 +1,99 @@
-import io
-import tempfile
-from typing import cast
+import asyncio
+import base64
+import contextlib
+import logging
+import queue
+import threading
+import time
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 
-from PIL import Image
 from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
 from webdriver_manager.chrome import ChromeDriverManager
 
+from app.adapters import assets
+
 WINDOW_WIDTH = 1920
 WINDOW_HEIGHT = 1080
 
+# Hosts the browser may still reach over the network. Everything a render
+# needs is served from the local asset store or inlined as a data url, so
+# all other network access is routed to an unreachable proxy.
+NETWORK_WHITELIST: tuple[str, ...] = ()
+BLACKHOLE_PROXY_SERVER = "http://127.0.0.1:9"
+
+
+class RenderQueueFullError(Exception):
+    def __init__(self, queue_depth: int) -> None:
+        super().__init__(f"Render queue is full ({queue_depth} renders pending)")
+        self.queue_depth = queue_depth
+
+
+class RenderTimeoutError(Exception):
+    def __init__(self, timeout: float) -> None:
+        super().__init__(f"Render did not become ready within {timeout}s")
+        self.timeout = timeout
+
+
+class _Session:
+    def __init__(self, driver: webdriver.Chrome, frame_id: str) -> None:
+        self.driver = driver
+        self.frame_id = frame_id
+        self.render_count = 0
+
 
 class WebDriver:
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        pool_size: int,
+        max_renders_per_session: int,
+        max_queue_depth: int,
+        render_timeout: float,
+    ) -> None:
         self.options = Options()
         self.options.add_argument("--headless")
         self.options.add_argument("--no-sandbox")
         self.options.add_argument("--disable-dev-shm-usage")
 
-    def _capture_web_canvas(
-        self,
-        url: str,
-    ) -> bytes:
-        # create a new chrome session
-        with webdriver.Chrome(
-            service=Service(ChromeDriverManager().install()),
+        # allow templates to reference fonts & images from the local asset store
+        self.options.add_argument("--allow-file-access-from-files")
+
+        self.options.add_argument(f"--proxy-server={BLACKHOLE_PROXY_SERVER}")
+        if NETWORK_WHITELIST:
+            self.options.add_argument(
+                f"--proxy-bypass-list={';'.join(NETWORK_WHITELIST)}",
+            )
+
+        self.pool_size = pool_size
+        self.max_renders_per_session = max_renders_per_session
+        self.max_queue_depth = max_queue_depth
+        self.render_timeout = render_timeout
+
+        # resolve (and possibly download) the driver binary once, rather than per render
+        self.service_path = ChromeDriverManager().install()
+
+        self._idle_sessions: queue.LifoQueue[_Session] = queue.LifoQueue()
+        self._session_slots = threading.BoundedSemaphore(pool_size)
+
+        # one render thread per session, so renders never wait on each other
+        # for anything but a free chrome session.
+        self._render_executor = ThreadPoolExecutor(
+            max_workers=pool_size,
+            thread_name_prefix="webdriver-render",
+        )
+        self._pending_renders = 0
+
+    def _create_session(self) -> _Session:
+        driver = webdriver.Chrome(
+            service=Service(self.service_path),
             options=self.options,
-        ) as driver:
-            driver.get(url)
+        )
+
+        try:
             driver.set_window_size(WINDOW_WIDTH, WINDOW_HEIGHT)
 
             # Get current viewport size
@@ -45,35 +110,171 @@ class WebDriver:
                 WINDOW_HEIGHT + height_diff,
             )
 
-            html_tag_el = driver.find_element("tag name", "html")
-            return html_tag_el.screenshot_as_png
+            # Park the session on a blank document within the asset store, so
+            # documents written into it can load local fonts & images.
+            driver.get(f"{assets.get_assets_base_url()}/blank.html")
+
+            # bounds how long a render may wait for its document to become ready
+            driver.set_script_timeout(self.render_timeout)
+            frame_tree = driver.execute_cdp_cmd("Page.getFrameTree", {})
+        except Exception:
+            driver.quit()
+            raise
+
+        return _Session(driver, frame_tree["frameTree"]["frame"]["id"])
 
-    def capture_html_as_jpeg_image(
+    def _destroy_session(self, session: _Session) -> None:
+        try:
+            session.driver.quit()
+        except Exception:
+            logging.warning("Failed to quit chrome session", exc_info=True)
+
+    @contextlib.contextmanager
+    def _checkout_session(self) -> Iterator[_Session]:
+        self._session_slots.acquire()
+        try:
+            try:
+                session = self._idle_sessions.get_nowait()
+            except queue.Empty:
+                session = self._create_session()
+
+            try:
+                yield session
+            except WebDriverException:
+                # the browser may have crashed; never hand it out again
+                self._destroy_session(session)
+                raise
+            except BaseException:
+                self._return_session(session)
+                raise
+            else:
+                self._return_session(session)
+        finally:
+            self._session_slots.release()
+
+    def _return_session(self, session: _Session) -> None:
+        session.render_count += 1
+        if session.render_count >= self.max_renders_per_session:
+            # recycle long-lived sessions to keep chrome's memory usage in check
+            self._destroy_session(session)
+        else:
+            self._idle_sessions.put(session)
+
+    def warm_up(self) -> None:
+        """Pre-start chrome sessions so the first renders don't pay for a cold start."""
+        while self._idle_sessions.qsize() < self.pool_size:
+            self._idle_sessions.put(self._create_session())
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of renders waiting for a free chrome session."""
+        return max(self._pending_renders - self.pool_size, 0)
+
+    def close(self) -> None:
+        self._render_executor.shutdown(wait=True, cancel_futures=True)
+
+        while True:
+            try:
+                session = self._idle_sessions.get_nowait()
+            except queue.Empty:
+                break
+
+            self._destroy_session(session)
+
+    def capture_html_as_png_image(
         self,
         html_content: str,
     ) -> bytes:
-        with tempfile.NamedTemporaryFile(suffix=".html") as input_file:
-            input_file.write(html_content.encode())
-            input_file.seek(0)
+        with self._checkout_session() as session:
+            started_at = time.perf_counter()
+
+            # write the document straight into the page, no temporary files
+            session.driver.execute_cdp_cmd(
+                "Page.setDocumentContent",
+                {"frameId": session.frame_id, "html": html_content},
+            )
+            navigated_at = time.perf_counter()
+
+            # documents mark themselves as ready once all of their fonts
+            # & images have loaded, see templates/scorewatch_normal.html.
+            try:
+                session.driver.execute_async_script(
+                    """
+                    const done = arguments[arguments.length - 1];
+                    if (document.documentElement.dataset.renderReady === "true") {
+                        done();
+                    } else {
+                        document.addEventListener("render-ready", () => done());
+                    }
+                    """,
+                )
+            except TimeoutException:
+                raise RenderTimeoutError(self.render_timeout)
+            assets_loaded_at = time.perf_counter()
 
-            # Capture an image of the html content as a png file
-            image_content = self._capture_web_canvas(
-                f"file://{input_file.name}",
+            # capture losslessly, so the image is only lossily encoded
+            # once, to its final format & quality.
+            screenshot = session.driver.execute_cdp_cmd(
+                "Page.captureScreenshot",
+                {
+                    "format": "png",
+                    # the png is decoded straight away, so favour speed over size
+                    "optimizeForSpeed": True,
+                    "clip": {
+                        "x": 0,
+                        "y": 0,
+                        "width": WINDOW_WIDTH,
+                        "height": WINDOW_HEIGHT,
+                        "scale": 1,
+                    },
+                },
             )
+            captured_at = time.perf_counter()
+
+        logging.info(
+            "Rendered html as png image",
+            extra={
+                "navigation_ms": round((navigated_at - started_at) * 1000, 2),
+                "asset_load_ms": round((assets_loaded_at - navigated_at) * 1000, 2),
+                "screenshot_ms": round((captured_at - assets_loaded_at) * 1000, 2),
+                "total_ms": round((captured_at - started_at) * 1000, 2),
+            },
+        )
+
+        return base64.b64decode(screenshot["data"])
+
+    async def render_html_as_png_image(
+        self,
+        html_content: str,
+    ) -> bytes:
+        """Render html content on the render executor, off the event loop.
 
-        with (
-            io.BytesIO(image_content) as input_buffer,
-            io.BytesIO() as output_buffer,
-        ):
-            image = Image.open(input_buffer)
-            image = image.convert("RGB")  # RGBA -> RGB
-            image.load()
-
-            image.save(
-                output_buffer,
-                format="JPEG",
-                subsampling=0,
-                quality=100,
+        Raises `RenderQueueFullError` rather than queueing the render
+        when too many renders are already waiting for a chrome session.
+        """
+        if self.queue_depth >= self.max_queue_depth:
+            logging.warning(
+                "Rejecting render, render queue is full",
+                extra={
+                    "queue_depth": self.queue_depth,
+                    "max_queue_depth": self.max_queue_depth,
+                },
             )
+            raise RenderQueueFullError(self.queue_depth)
 
-            return output_buffer.getvalue()
+        self._pending_renders += 1
+        try:
+            if self.queue_depth > 0:
+                logging.info(
+                    "All chrome sessions are busy, render has been queued",
+                    extra={"queue_depth": self.queue_depth},
+                )
+
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._render_executor,
+                self.capture_html_as_png_image,
+                html_content,
+            )
+        finally:
+            self._pending_renders -= 1
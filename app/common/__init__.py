@@ -1,2 +1,5 @@
+from . import batching
+from . import cache
 from . import settings
+from . import templates
 from . import views
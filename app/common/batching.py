@@ -0,0 +1,77 @@
+import asyncio
+from collections.abc import Awaitable
+from collections.abc import Callable
+from typing import Generic
+from typing import TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class MicroBatcher(Generic[T, R]):
+    """Combines concurrent async calls into batched calls.
+
+    Items submitted within `max_delay` seconds of each other (up to
+    `max_batch_size` of them) are passed to `func` together, which must
+    return a result for each item, in the same order. Every caller gets its
+    own item's result, or the exception the batch failed with.
+    """
+
+    def __init__(
+        self,
+        func: Callable[[list[T]], Awaitable[list[R]]],
+        max_batch_size: int,
+        max_delay: float,
+    ) -> None:
+        self.func = func
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+
+        self._pending: list[tuple[T, asyncio.Future[R]]] = []
+        self._flush_handle: asyncio.TimerHandle | None = None
+        # keeps running batches referenced until they're done
+        self._batches: set[asyncio.Task[None]] = set()
+
+    async def submit(self, item: T) -> R:
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[R] = loop.create_future()
+        self._pending.append((item, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_delay, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, []
+        task = asyncio.create_task(self._run_batch(batch))
+        self._batches.add(task)
+        task.add_done_callback(self._batches.discard)
+
+    async def _run_batch(self, batch: list[tuple[T, asyncio.Future[R]]]) -> None:
+        try:
+            results = await self.func([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(
+                    f"Expected {len(batch)} results from batch, got {len(results)}",
+                )
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as exc:
+            for _, future in batch:
+                # callers may have stopped waiting
+                if not future.done():
+                    future.set_exception(exc)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
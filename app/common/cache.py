@@ -0,0 +1,304 @@
+import asyncio
+import functools
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable
+from collections.abc import Callable
+from collections.abc import Hashable
+from typing import Any
+from typing import Generic
+from typing import ParamSpec
+from typing import TypedDict
+from typing import TypeVar
+
+K = TypeVar("K")
+V = TypeVar("V")
+P = ParamSpec("P")
+
+
+class CacheStats(TypedDict):
+    hits: int
+    misses: int
+    entries: int
+    size: int
+
+
+def _count_entry(value: object) -> int:
+    return 1
+
+
+class LRUCache(Generic[K, V]):
+    """An in-memory cache which evicts the least recently used entries
+    once their total size exceeds `max_size`.
+
+    By default every entry has a size of 1, so `max_size` bounds the number
+    of entries; pass `get_size` (e.g. `len`) to bound something else. With a
+    `ttl` (in seconds), entries also expire that long after they're set.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        get_size: Callable[[V], int] = _count_entry,
+        ttl: float | None = None,
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._get_size = get_size
+        self._entries: OrderedDict[K, V] = OrderedDict()
+        self._expires_at: dict[K, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._entries
+
+    def get(self, key: K) -> V | None:
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        expires_at = self._expires_at.get(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self.delete(key)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: K, value: V) -> None:
+        if key in self._entries:
+            self.size -= self._get_size(self._entries[key])
+
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        self.size += self._get_size(value)
+        if self.ttl is not None:
+            self._expires_at[key] = time.monotonic() + self.ttl
+
+        while self.size > self.max_size:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self._expires_at.pop(evicted_key, None)
+            self.size -= self._get_size(evicted)
+
+    def delete(self, key: K) -> None:
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self._expires_at.pop(key, None)
+            self.size -= self._get_size(value)
+
+    def keys(self) -> list[K]:
+        return list(self._entries)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._expires_at.clear()
+        self.size = 0
+
+    def stats(self) -> CacheStats:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "size": self.size,
+        }
+
+
+class DiskCache:
+    """A directory of cached files, which evicts the least recently used
+    files once their total size exceeds `max_size` bytes.
+
+    Files are written atomically, and recency survives restarts through
+    file modification times. Methods block on disk io, so should be run
+    in a thread from async code.
+    """
+
+    def __init__(self, directory: str, max_size: int) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._file_sizes: OrderedDict[str, int] = OrderedDict()
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self) -> None:
+        files: list[tuple[float, str, int]] = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+
+            if entry.name.endswith(".tmp"):
+                # left behind by an interrupted write
+                os.remove(entry.path)
+                continue
+
+            stat = entry.stat()
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _, file_name, file_size in sorted(files):
+            self._file_sizes[file_name] = file_size
+            self.size += file_size
+
+        self._evict()
+
+    def _file_name(self, key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _evict(self) -> None:
+        while self.size > self.max_size:
+            file_name, file_size = self._file_sizes.popitem(last=False)
+            self.size -= file_size
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except FileNotFoundError:
+                pass
+
+    def get(self, key: str) -> bytes | None:
+        file_name = self._file_name(key)
+        path = os.path.join(self.directory, file_name)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+                file_size = self._file_sizes.pop(file_name, None)
+                if file_size is not None:
+                    self.size -= file_size
+            return None
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        with self._lock:
+            self.hits += 1
+            if file_name in self._file_sizes:
+                self._file_sizes.move_to_end(file_name)
+
+        return data
+
+    def set(self, key: str, data: bytes) -> None:
+        file_name = self._file_name(key)
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, os.path.join(self.directory, file_name))
+        except OSError:
+            logging.warning(
+                "Failed to write file to disk cache",
+                exc_info=True,
+                extra={"directory": self.directory},
+            )
+            return
+
+        with self._lock:
+            self.size -= self._file_sizes.pop(file_name, 0)
+            self._file_sizes[file_name] = len(data)
+            self.size += len(data)
+            self._evict()
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._file_sizes),
+                "size": self.size,
+            }
+
+
+class SingleFlightStats(TypedDict):
+    calls: int
+    # calls which shared another call's result, rather than making their own
+    coalesced: int
+    in_flight: int
+
+
+# every single-flight group, by name
+_single_flights: dict[str, "SingleFlight[Any, Any]"] = {}
+
+
+class SingleFlight(Generic[K, V]):
+    """De-duplicates concurrent async calls which share a key.
+
+    The first caller for a key starts the call, and everyone else asking for
+    the same key while it's in flight awaits its result (or exception),
+    rather than starting their own. Cancelling one caller doesn't cancel the
+    call for the others.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.calls = 0
+        self.coalesced = 0
+
+        self._calls: dict[K, asyncio.Task[V]] = {}
+        _single_flights[name] = self
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: K, func: Callable[[], Awaitable[V]]) -> V:
+        self.calls += 1
+
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.coalesced += 1
+
+        return await asyncio.shield(task)
+
+    def stats(self) -> SingleFlightStats:
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._calls),
+        }
+
+
+def single_flight(
+    func: Callable[P, Awaitable[V]],
+) -> Callable[P, Awaitable[V]]:
+    """Coalesce concurrent calls to an async function with the same arguments.
+
+    Callers share the result, so it shouldn't be mutated.
+    """
+    flight: SingleFlight[Hashable, V] = SingleFlight(
+        f"{func.__module__}.{func.__qualname__}",
+    )
+
+    @functools.wraps(func)
+    async def wrapper(*args: P.args, **kwargs: P.kwargs) -> V:
+        key = (args, tuple(sorted(kwargs.items())))
+        return await flight.do(key, lambda: func(*args, **kwargs))
+
+    return wrapper
+
+
+def get_single_flight_stats() -> dict[str, SingleFlightStats]:
+    return {name: flight.stats() for name, flight in _single_flights.items()}
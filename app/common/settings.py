@@ -7,6 +7,12 @@ def read_bool(value: str) -> bool:
     return value.lower() == "true"  # keep it simple
 
 
+def read_choice(value: str, choices: tuple[str, ...]) -> str:
+    if value not in choices:
+        raise ValueError(f"Expected one of {choices}, got {value!r}")
+    return value
+
+
 load_dotenv()
 
 
@@ -61,3 +67,46 @@ AWS_S3_ACCESS_KEY_ID = os.environ["AWS_S3_ACCESS_KEY_ID"]
 AWS_S3_SECRET_ACCESS_KEY = os.environ["AWS_S3_SECRET_ACCESS_KEY"]
 AWS_S3_BUCKET_NAME = os.environ["AWS_S3_BUCKET_NAME"]
 AWS_S3_ENDPOINT_URL = os.environ["AWS_S3_ENDPOINT_URL"]
+
+WEBDRIVER_POOL_SIZE = int(os.environ["WEBDRIVER_POOL_SIZE"])
+WEBDRIVER_MAX_RENDERS_PER_SESSION = int(os.environ["WEBDRIVER_MAX_RENDERS_PER_SESSION"])
+WEBDRIVER_MAX_QUEUE_DEPTH = int(os.environ["WEBDRIVER_MAX_QUEUE_DEPTH"])
+WEBDRIVER_RENDER_TIMEOUT = int(os.environ["WEBDRIVER_RENDER_TIMEOUT"])
+
+# processed beatmap backgrounds, cached in memory & on disk (sizes in bytes)
+BACKGROUND_CACHE_MEMORY_SIZE = int(os.environ["BACKGROUND_CACHE_MEMORY_SIZE"])
+BACKGROUND_CACHE_DIRECTORY = os.environ["BACKGROUND_CACHE_DIRECTORY"]
+BACKGROUND_CACHE_DISK_SIZE = int(os.environ["BACKGROUND_CACHE_DISK_SIZE"])
+
+# .osu files by md5, cached in memory & compressed on disk (sizes in bytes)
+OSU_FILE_CACHE_MEMORY_SIZE = int(os.environ["OSU_FILE_CACHE_MEMORY_SIZE"])
+OSU_FILE_CACHE_DIRECTORY = os.environ["OSU_FILE_CACHE_DIRECTORY"]
+OSU_FILE_CACHE_DISK_SIZE = int(os.environ["OSU_FILE_CACHE_DISK_SIZE"])
+# the number of parsed beatmap metadata records kept in memory
+BEATMAP_METADATA_CACHE_SIZE = int(os.environ["BEATMAP_METADATA_CACHE_SIZE"])
+
+# calculated performance results, by their inputs; expiring after a ttl (in
+# seconds) as calculations change, and optionally persisted to the database
+PERFORMANCE_CACHE_SIZE = int(os.environ["PERFORMANCE_CACHE_SIZE"])
+PERFORMANCE_CACHE_TTL = int(os.environ["PERFORMANCE_CACHE_TTL"])
+PERFORMANCE_CACHE_PERSIST = read_bool(os.environ["PERFORMANCE_CACHE_PERSIST"])
+
+# the number of processes used for cpu-bound image work
+IMAGE_WORKER_COUNT = int(os.environ["IMAGE_WORKER_COUNT"])
+
+# the engine used to render thumbnails, either "chrome" or "pillow"
+RENDER_ENGINE = read_choice(os.environ["RENDER_ENGINE"], ("chrome", "pillow"))
+
+# the number of rendered thumbnails kept in memory
+THUMBNAIL_CACHE_SIZE = int(os.environ["THUMBNAIL_CACHE_SIZE"])
+
+# how thumbnails are encoded, either "jpeg" or "webp"; youtube only accepts jpeg
+# NOTE: keep in sync with `FILE_EXTENSIONS` in app/usecases/postprocessing.py
+THUMBNAIL_IMAGE_FORMAT = read_choice(
+    os.environ["THUMBNAIL_IMAGE_FORMAT"],
+    ("jpeg", "webp"),
+)
+# the most bytes an uploaded thumbnail may take, youtube's limit is 2MB
+THUMBNAIL_MAX_SIZE = int(os.environ["THUMBNAIL_MAX_SIZE"])
+# the width of the preview thumbnail attached to discord messages
+THUMBNAIL_PREVIEW_WIDTH = int(os.environ["THUMBNAIL_PREVIEW_WIDTH"])
@@ -0,0 +1,108 @@
+import hashlib
+import html
+import io
+import logging
+import os
+import re
+from collections.abc import Mapping
+
+PLACEHOLDER_PATTERN = re.compile(r"<%\s*([\w.]+)\s*%>")
+
+TemplateValue = str | int | float
+
+
+class Markup(str):
+    """A string which is already safe html, and won't be escaped when rendered."""
+
+
+class TemplateRenderError(Exception):
+    pass
+
+
+class Template:
+    def __init__(self, name: str, source: str) -> None:
+        self.name = name
+
+        # identifies this exact revision of the template, e.g. for cache keys
+        self.digest = hashlib.sha256(source.encode()).hexdigest()
+
+        # `re.split` with a capture group alternates between the static
+        # chunks and placeholder names, always starting & ending with a chunk.
+        tokens = PLACEHOLDER_PATTERN.split(source)
+        self._chunks = tokens[0::2]
+        self._names = tokens[1::2]
+
+        self.placeholders = frozenset(self._names)
+
+    def render(self, context: Mapping[str, TemplateValue]) -> str:
+        missing = self.placeholders - context.keys()
+        if missing:
+            raise TemplateRenderError(
+                f"Missing values for {', '.join(sorted(missing))} "
+                f"in template {self.name!r}",
+            )
+
+        values = {name: _escape(context[name]) for name in self.placeholders}
+
+        with io.StringIO() as buffer:
+            for chunk, name in zip(self._chunks, self._names):
+                buffer.write(chunk)
+                buffer.write(values[name])
+            buffer.write(self._chunks[-1])
+
+            return buffer.getvalue()
+
+
+def _escape(value: TemplateValue) -> str:
+    if isinstance(value, Markup):
+        return value
+
+    return html.escape(str(value))
+
+
+class TemplateEngine:
+    """Loads & tokenizes every template in a directory once, up front.
+
+    With `auto_reload` enabled, templates are re-read from disk whenever
+    their modification time changes, which is handy during development.
+    """
+
+    def __init__(self, directory: str, auto_reload: bool = False) -> None:
+        self.directory = directory
+        self.auto_reload = auto_reload
+
+        self._templates: dict[str, Template] = {}
+        self._mtimes: dict[str, float] = {}
+
+        for file_name in os.listdir(directory):
+            name, ext = os.path.splitext(file_name)
+            if ext == ".html":
+                self._load(name)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, f"{name}.html")
+
+    def _load(self, name: str) -> Template:
+        path = self._path(name)
+        with open(path) as f:
+            template = Template(name, f.read())
+
+        self._templates[name] = template
+        self._mtimes[name] = os.path.getmtime(path)
+        return template
+
+    def get_template(self, name: str) -> Template:
+        if name not in self._templates:
+            raise TemplateRenderError(f"Unknown template {name!r}")
+
+        if (
+            self.auto_reload
+            and os.path.getmtime(self._path(name)) != self._mtimes[name]
+        ):
+            logging.info("Reloading modified template", extra={"template": name})
+            return self._load(name)
+
+        return self._templates[name]
+
+    def render(self, name: str, context: Mapping[str, TemplateValue]) -> str:
+        return self.get_template(name).render(context)
@@ -7,6 +7,7 @@ from urllib import parse
 import discord
 from discord.ext import commands
 
+from app.adapters import upstream
 from app.common import settings
 from app.constants import Status
 from app.constants import VoteType
@@ -239,10 +240,16 @@ class ScorewatchVoteButton(discord.ui.Button[Any]):
             datetime.datetime.now(datetime.UTC),
         )
 
-        score_data = await scores.fetch_one(
-            request_data["score_id"],
-            request_data["score_relax"],
-        )
+        try:
+            score_data = await scores.fetch_one(
+                request_data["score_id"],
+                request_data["score_relax"],
+            )
+        except upstream.ServiceUnavailableError:
+            await interaction.channel.send(
+                "The Akatsuki API is unavailable right now, the score couldn't be fetched!",
+            )
+            return None
 
         if not score_data:
             await interaction.channel.send(
@@ -305,8 +312,8 @@ class ScorewatchVoteButton(discord.ui.Button[Any]):
                     ),
                 ),
                 file=discord.File(
-                    io.BytesIO(upload_data["image_data"]),
-                    filename="thumbnail.jpg",
+                    io.BytesIO(upload_data["preview_image_data"]),
+                    filename=f"thumbnail.{upload_data['file_extension']}",
                 ),
             )
 
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import asyncio
 import base64
 import io
 import os
@@ -11,7 +12,6 @@ from urllib import parse
 
 import aiobotocore.session
 import discord
-import httpx
 from aiosu.models.mods import Mod
 from discord import app_commands
 from discord.ext import commands
@@ -24,8 +24,11 @@ sys.path.append(srv_root)
 from app import osu_replays, logger
 from app.common import views
 from app.usecases import scorewatch
+from app.usecases import postprocessing
 from app.common import settings
+from app.common import templates
 from app.adapters import database
+from app.adapters import upstream
 from app.adapters import webdriver
 from app import state
 from app.constants import Status
@@ -48,90 +51,118 @@ class Bot(commands.Bot):
             **kwargs,
         )
 
+    async def setup_hook(self) -> None:
+        # runs once, after logging in; unlike `on_ready`, which also fires
+        # after every reconnect to the gateway.
+        state.read_database = database.Database(
+            database.dsn(
+                scheme="postgresql",
+                user=settings.READ_DB_USER,
+                password=settings.READ_DB_PASS,
+                host=settings.READ_DB_HOST,
+                port=settings.READ_DB_PORT,
+                database=settings.READ_DB_NAME,
+            ),
+            db_ssl=(
+                ssl.create_default_context(
+                    purpose=ssl.Purpose.SERVER_AUTH,
+                    cadata=base64.b64decode(settings.READ_DB_CA_CERTIFICATE).decode(),
+                )
+                if settings.READ_DB_USE_SSL
+                else False
+            ),
+            min_pool_size=settings.DB_POOL_MIN_SIZE,
+            max_pool_size=settings.DB_POOL_MAX_SIZE,
+        )
+        await state.read_database.connect()
+
+        state.write_database = database.Database(
+            database.dsn(
+                scheme="postgresql",
+                user=settings.WRITE_DB_USER,
+                password=settings.WRITE_DB_PASS,
+                host=settings.WRITE_DB_HOST,
+                port=settings.WRITE_DB_PORT,
+                database=settings.WRITE_DB_NAME,
+            ),
+            db_ssl=(
+                ssl.create_default_context(
+                    purpose=ssl.Purpose.SERVER_AUTH,
+                    cadata=base64.b64decode(settings.WRITE_DB_CA_CERTIFICATE).decode(),
+                )
+                if settings.WRITE_DB_USE_SSL
+                else False
+            ),
+            min_pool_size=settings.DB_POOL_MIN_SIZE,
+            max_pool_size=settings.DB_POOL_MAX_SIZE,
+        )
+        await state.write_database.connect()
 
-intents = discord.Intents.default()
-intents.message_content = True
-intents.members = True
-intents.guilds = True
-
-bot = Bot(intents=intents)
+        state.templates = templates.TemplateEngine(
+            "templates",
+            auto_reload=settings.APP_ENV == "local",
+        )
+        state.image_process_pool = postprocessing.create_image_process_pool(
+            settings.IMAGE_WORKER_COUNT,
+        )
+        await asyncio.to_thread(
+            postprocessing.warm_up_image_process_pool,
+            state.image_process_pool,
+            settings.IMAGE_WORKER_COUNT,
+        )
+        if settings.RENDER_ENGINE == "chrome":
+            # resolving the chrome driver may download it, so keep it off the loop
+            state.webdriver = await asyncio.to_thread(
+                webdriver.WebDriver,
+                pool_size=settings.WEBDRIVER_POOL_SIZE,
+                max_renders_per_session=settings.WEBDRIVER_MAX_RENDERS_PER_SESSION,
+                max_queue_depth=settings.WEBDRIVER_MAX_QUEUE_DEPTH,
+                render_timeout=settings.WEBDRIVER_RENDER_TIMEOUT,
+            )
+            await asyncio.to_thread(state.webdriver.warm_up)
+
+        aws_session = aiobotocore.session.get_session()
+        s3_client = aws_session.create_client(
+            service_name="s3",
+            region_name=settings.AWS_S3_REGION_NAME,
+            endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+            aws_access_key_id=settings.AWS_S3_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.AWS_S3_SECRET_ACCESS_KEY,
+        )
+        state.s3_client = await s3_client.__aenter__()
 
+        # Load views so the existing one will still work.
+        self.add_view(views.ReportView(self))
+        for sw_request in await sw_requests.fetch_all():
+            if sw_request["request_status"] in Status.resolved_statuses():
+                continue  # No point in adding already resolved requests perhaps threads are even gone by now.
 
-@bot.event
-async def on_ready() -> None:
-    state.read_database = database.Database(
-        database.dsn(
-            scheme="postgresql",
-            user=settings.READ_DB_USER,
-            password=settings.READ_DB_PASS,
-            host=settings.READ_DB_HOST,
-            port=settings.READ_DB_PORT,
-            database=settings.READ_DB_NAME,
-        ),
-        db_ssl=(
-            ssl.create_default_context(
-                purpose=ssl.Purpose.SERVER_AUTH,
-                cadata=base64.b64decode(settings.READ_DB_CA_CERTIFICATE).decode(),
+            self.add_view(
+                views.ScorewatchButtonView(sw_request["score_id"], self),
+                message_id=sw_request["thread_message_id"],
             )
-            if settings.READ_DB_USE_SSL
-            else False
-        ),
-        min_pool_size=settings.DB_POOL_MIN_SIZE,
-        max_pool_size=settings.DB_POOL_MAX_SIZE,
-    )
-    await state.read_database.connect()
-
-    state.write_database = database.Database(
-        database.dsn(
-            scheme="postgresql",
-            user=settings.WRITE_DB_USER,
-            password=settings.WRITE_DB_PASS,
-            host=settings.WRITE_DB_HOST,
-            port=settings.WRITE_DB_PORT,
-            database=settings.WRITE_DB_NAME,
-        ),
-        db_ssl=(
-            ssl.create_default_context(
-                purpose=ssl.Purpose.SERVER_AUTH,
-                cadata=base64.b64decode(settings.WRITE_DB_CA_CERTIFICATE).decode(),
-            )
-            if settings.WRITE_DB_USE_SSL
-            else False
-        ),
-        min_pool_size=settings.DB_POOL_MIN_SIZE,
-        max_pool_size=settings.DB_POOL_MAX_SIZE,
-    )
-    await state.write_database.connect()
 
-    state.http_client = httpx.AsyncClient(
-        follow_redirects=True,
-        timeout=30,
-        headers={"User-Agent": "akatsuki/management-bot"},
-    )
-    state.webdriver = webdriver.WebDriver()
-
-    aws_session = aiobotocore.session.get_session()
-    s3_client = aws_session.create_client(
-        service_name="s3",
-        region_name=settings.AWS_S3_REGION_NAME,
-        endpoint_url=settings.AWS_S3_ENDPOINT_URL,
-        aws_access_key_id=settings.AWS_S3_ACCESS_KEY_ID,
-        aws_secret_access_key=settings.AWS_S3_SECRET_ACCESS_KEY,
-    )
-    state.s3_client = await s3_client.__aenter__()
+        await self.tree.sync()
 
-    # Load views so the existing one will still work.
-    bot.add_view(views.ReportView(bot))
-    for sw_request in await sw_requests.fetch_all():
-        if sw_request["request_status"] in Status.resolved_statuses():
-            continue  # No point in adding already resolved requests perhaps threads are even gone by now.
+    async def close(self) -> None:
+        await super().close()
 
-        bot.add_view(
-            views.ScorewatchButtonView(sw_request["score_id"], bot),
-            message_id=sw_request["thread_message_id"],
-        )
+        # NOTE: state is only populated once `setup_hook` has run
+        if hasattr(state, "webdriver"):
+            state.webdriver.close()
+
+        if hasattr(state, "image_process_pool"):
+            state.image_process_pool.shutdown(cancel_futures=True)
 
-    await bot.tree.sync()
+        await upstream.close()
+
+
+intents = discord.Intents.default()
+intents.message_content = True
+intents.members = True
+intents.guilds = True
+
+bot = Bot(intents=intents)
 
 
 @bot.tree.command(
@@ -250,6 +281,13 @@ async def request(
     score_id = int(score_id_str)
 
     osu_replay = await osu_replays.get_replay(score_id)
+    if not osu_replay and not upstream.is_available("scores"):
+        await interaction.followup.send(
+            "The score service is unavailable right now, please try again in a few minutes!",
+            ephemeral=True,
+        )
+        return
+
     if not osu_replay:
         await interaction.followup.send(
             "Failed to parse the replay file!",
@@ -275,7 +313,15 @@ async def request(
         relax = 2
         relax_text = "AP"
 
-    score_data = await scores.fetch_one(score_id, relax)
+    try:
+        score_data = await scores.fetch_one(score_id, relax)
+    except upstream.ServiceUnavailableError:
+        await interaction.followup.send(
+            "The Akatsuki API is unavailable right now, please try again in a few minutes!",
+            ephemeral=True,
+        )
+        return
+
     if not score_data:
         await interaction.followup.send(
             "Could not find this score!",
@@ -405,7 +451,15 @@ async def generate(
         return
 
     relax = scorewatch.get_relax_from_score_id(int(score_id))
-    score_data = await scores.fetch_one(int(score_id), relax)
+    try:
+        score_data = await scores.fetch_one(int(score_id), relax)
+    except upstream.ServiceUnavailableError:
+        await interaction.followup.send(
+            "The Akatsuki API is unavailable right now, please try again in a few minutes!",
+            ephemeral=True,
+        )
+        return
+
     if not score_data:
         await interaction.followup.send(
             "Could not find this score!",
@@ -438,8 +492,8 @@ async def generate(
             ),
         ),
         file=discord.File(
-            io.BytesIO(upload_data["image_data"]),
-            filename="thumbnail.jpg",
+            io.BytesIO(upload_data["preview_image_data"]),
+            filename=f"thumbnail.{upload_data['file_extension']}",
         ),
     )
 
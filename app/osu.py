@@ -1,5 +1,8 @@
 from __future__ import annotations
 
+import numpy as np
+import numpy.typing as npt
+
 
 def to_osu_mode_readable(mode: int) -> str:
     return {
@@ -17,3 +20,86 @@ def int_to_osu_name(mode: int) -> str:
         2: "fruits",
         3: "mania",
     }[mode]
+
+
+# the osu! difficulty colour spectrum, as used by osu!web
+DIFFICULTY_COLOUR_DOMAIN = (0.1, 1.25, 2.0, 2.5, 3.3, 4.2, 4.9, 5.8, 6.7, 7.7, 9.0)
+DIFFICULTY_COLOUR_RANGE = (
+    "#4290FB",
+    "#4FC0FF",
+    "#4FFFD5",
+    "#7CFF4F",
+    "#F6F05C",
+    "#FF8068",
+    "#FF4E6F",
+    "#C645B8",
+    "#6563DE",
+    "#18158E",
+    "#000000",
+)
+DIFFICULTY_COLOUR_GAMMA = 2.2
+DIFFICULTY_COLOUR_RESOLUTION = 100  # lookup table entries per star
+
+DIFFICULTY_TEXT_COLOUR = "#303d47"
+HIGH_DIFFICULTY_TEXT_COLOUR = "#ffd966"
+
+
+def _build_difficulty_colour_table() -> npt.NDArray[np.uint8]:
+    """Precompute the difficulty spectrum for every star rating in [0, 9].
+
+    Stops are interpolated in gamma-2.2 space, matching d3's
+    `interpolateRgb.gamma(2.2)` which osu!web uses to colour difficulties.
+    """
+
+    stops = np.array(
+        [
+            [int(colour[i : i + 2], 16) for i in (1, 3, 5)]
+            for colour in DIFFICULTY_COLOUR_RANGE
+        ],
+        dtype=np.float64,
+    )
+    gamma_stops = stops**DIFFICULTY_COLOUR_GAMMA
+
+    star_ratings = (
+        np.arange(
+            0,
+            DIFFICULTY_COLOUR_DOMAIN[-1] * DIFFICULTY_COLOUR_RESOLUTION + 1,
+        )
+        / DIFFICULTY_COLOUR_RESOLUTION
+    )
+
+    table = np.empty((len(star_ratings), 3), dtype=np.float64)
+    for channel in range(3):
+        table[:, channel] = np.interp(
+            star_ratings,
+            DIFFICULTY_COLOUR_DOMAIN,
+            gamma_stops[:, channel],
+        )
+
+    table = table ** (1 / DIFFICULTY_COLOUR_GAMMA)
+
+    # ratings below the spectrum are greyed out
+    table[star_ratings < DIFFICULTY_COLOUR_DOMAIN[0]] = 0xAA
+    return np.clip(np.round(table), 0, 255).astype(np.uint8)
+
+
+_DIFFICULTY_COLOUR_TABLE = _build_difficulty_colour_table()
+
+
+def get_difficulty_colour_rgb(star_rating: float) -> tuple[int, int, int]:
+    index = round(star_rating * DIFFICULTY_COLOUR_RESOLUTION)
+    index = min(max(index, 0), len(_DIFFICULTY_COLOUR_TABLE) - 1)
+
+    red, green, blue = _DIFFICULTY_COLOUR_TABLE[index]
+    return int(red), int(green), int(blue)
+
+
+def get_difficulty_colour(star_rating: float) -> str:
+    return "#{:02x}{:02x}{:02x}".format(*get_difficulty_colour_rgb(star_rating))
+
+
+def get_difficulty_text_colour(star_rating: float) -> str:
+    if star_rating >= 6.5:
+        return HIGH_DIFFICULTY_TEXT_COLOUR
+
+    return DIFFICULTY_TEXT_COLOUR
@@ -0,0 +1,27 @@
+import logging
+import typing
+
+from app.adapters import upstream
+
+
+class Avatar(typing.TypedDict):
+    content_type: str
+    data: bytes
+
+
+async def get_avatar_image_contents(user_id: int) -> Avatar | None:
+    try:
+        response = await upstream.get_client("avatars").get(f"/{user_id}")
+        response.raise_for_status()
+    except Exception:
+        logging.warning(
+            "Failed to retrieve user avatar image",
+            extra={"user_id": user_id},
+            exc_info=True,
+        )
+        return None
+
+    return {
+        "content_type": response.headers.get("Content-Type", "image/png"),
+        "data": response.read(),
+    }
@@ -1,27 +1,30 @@
+import codecs
 import logging
 import typing
 
-import httpx
-
-from app.common import settings
-
-
-beatmaps_service_http_client = httpx.AsyncClient(
-    base_url=settings.APP_BEATMAPS_SERVICE_URL,
-)
+from app.adapters import upstream
+from app.common.cache import single_flight
 
 
 class BeatmapMetadata(typing.TypedDict):
     artist: str
+    artist_unicode: str
     title: str
+    title_unicode: str
     creator: str
     version: str
+    source: str
+    tags: list[str]
+    beatmap_id: int | None
+    beatmapset_id: int | None
 
 
+@single_flight
 async def get_osu_file_contents(beatmap_id: int) -> bytes | None:
     """Fetch the .osu file content for a beatmap."""
     try:
-        response = await beatmaps_service_http_client.get(
+        response = await upstream.hedged_get(
+            "beatmaps",
             f"/api/osu-api/v1/osu-files/{beatmap_id}",
         )
 
@@ -41,7 +44,7 @@ async def get_osu_file_contents(beatmap_id: int) -> bytes | None:
 async def get_osz_file_contents(beatmapset_id: int) -> bytes | None:
     """Fetch the .osz file content for a beatmapset."""
     try:
-        response = await beatmaps_service_http_client.get(
+        response = await upstream.get_client("beatmaps").get(
             f"/public/api/d/{beatmapset_id}",
         )
         if response.status_code == 404:
@@ -57,9 +60,37 @@ async def get_osz_file_contents(beatmapset_id: int) -> bytes | None:
         return None
 
 
+async def download_osz_file(beatmapset_id: int, file: typing.IO[bytes]) -> bool:
+    """Stream the .osz file of a beatmapset into `file`, chunk by chunk.
+
+    Returns whether the whole file was downloaded.
+    """
+    try:
+        async with upstream.get_client("beatmaps").stream(
+            "GET",
+            f"/public/api/d/{beatmapset_id}",
+        ) as response:
+            if response.status_code == 404:
+                return False
+            response.raise_for_status()
+
+            async for chunk in response.aiter_bytes():
+                file.write(chunk)
+
+            return True
+    except Exception:
+        logging.warning(
+            "Failed to download .osz file from beatmaps-service",
+            extra={"beatmapset_id": beatmapset_id},
+            exc_info=True,
+        )
+        return False
+
+
 async def get_beatmap_background_image_contents(beatmap_id: int) -> bytes | None:
     try:
-        response = await beatmaps_service_http_client.get(
+        response = await upstream.hedged_get(
+            "beatmaps",
             f"/api/osu-assets/backgrounds/{beatmap_id}",
         )
 
@@ -79,17 +110,191 @@ async def get_beatmap_background_image_contents(beatmap_id: int) -> bytes | None
         return None
 
 
+# [Metadata] keys, and the fields of `BeatmapMetadata` they're parsed into
+METADATA_FIELDS = {
+    "Artist": "artist",
+    "ArtistUnicode": "artist_unicode",
+    "Title": "title",
+    "TitleUnicode": "title_unicode",
+    "Creator": "creator",
+    "Version": "version",
+    "Source": "source",
+    "Tags": "tags",
+    "BeatmapID": "beatmap_id",
+    "BeatmapSetID": "beatmapset_id",
+}
+
+# sections which come after [Metadata], reaching any means it's been parsed
+SECTIONS_AFTER_METADATA = frozenset(
+    ("Difficulty", "Events", "TimingPoints", "Colours", "HitObjects"),
+)
+
+BYTE_ORDER_MARKS = (
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+PARSE_CHUNK_SIZE = 4096
+
+
+class BeatmapMetadataParser:
+    """Parses the [Metadata] section of a .osu file, fed in chunks of bytes.
+
+    Parsing stops as soon as the section ends, so the remainder of the file
+    (usually thousands of hit objects) never needs to be read or decoded.
+    """
+
+    def __init__(self) -> None:
+        self.done = False
+
+        self._head = b""
+        self._decoder: codecs.IncrementalDecoder | None = None
+        self._buffer = ""
+        self._section: str | None = None
+        self._values: dict[str, str] = {}
+
+    def _create_decoder(self) -> codecs.IncrementalDecoder:
+        encoding = "utf-8"
+        for byte_order_mark, bom_encoding in BYTE_ORDER_MARKS:
+            if self._head.startswith(byte_order_mark):
+                encoding = bom_encoding
+                break
+
+        return codecs.getincrementaldecoder(encoding)(errors="replace")
+
+    def _parse_line(self, line: str) -> None:
+        line = line.strip()
+        if line.startswith("[") and line.endswith("]"):
+            if self._section == "Metadata" or line[1:-1] in SECTIONS_AFTER_METADATA:
+                self.done = True
+            self._section = line[1:-1]
+            return
+
+        if self._section != "Metadata":
+            return
+
+        key, separator, value = line.partition(":")
+        if separator and key.strip() in METADATA_FIELDS:
+            self._values[METADATA_FIELDS[key.strip()]] = value.strip()
+
+    def feed(self, chunk: bytes) -> bool:
+        """Parse the next chunk of the file, returning whether parsing is done."""
+        if self.done:
+            return True
+
+        if self._decoder is None:
+            # wait for enough bytes to tell whether the file starts with a bom
+            self._head += chunk
+            if len(self._head) < len(codecs.BOM_UTF8):
+                return False
+
+            self._decoder = self._create_decoder()
+            chunk, self._head = self._head, b""
+
+        *lines, self._buffer = (self._buffer + self._decoder.decode(chunk)).split("\n")
+        for line in lines:
+            self._parse_line(line)
+            if self.done:
+                break
+
+        return self.done
+
+    def _parse_int(self, field: str) -> int | None:
+        try:
+            value = int(self._values.get(field, ""))
+        except ValueError:
+            return None
+
+        # older beatmaps use -1 for ids they weren't assigned
+        return value if value > 0 else None
+
+    def finish(self) -> BeatmapMetadata:
+        """Parse anything left over, and get the parsed metadata."""
+        if not self.done:
+            if self._decoder is None:
+                self._decoder = self._create_decoder()
+                self._buffer += self._decoder.decode(self._head, final=True)
+            else:
+                self._buffer += self._decoder.decode(b"", final=True)
+
+            for line in self._buffer.split("\n"):
+                self._parse_line(line)
+
+        artist = self._values.get("artist", "")
+        title = self._values.get("title", "")
+        return {
+            "artist": artist,
+            # older beatmaps only have romanised metadata
+            "artist_unicode": self._values.get("artist_unicode") or artist,
+            "title": title,
+            "title_unicode": self._values.get("title_unicode") or title,
+            "creator": self._values.get("creator", ""),
+            "version": self._values.get("version", ""),
+            "source": self._values.get("source", ""),
+            "tags": self._values.get("tags", "").split(),
+            "beatmap_id": self._parse_int("beatmap_id"),
+            "beatmapset_id": self._parse_int("beatmapset_id"),
+        }
+
+
 def parse_beatmap_metadata(osu_file_bytes: bytes) -> BeatmapMetadata:
-    lines = osu_file_bytes.decode().splitlines()
-    beatmap: dict[str, str] = {}
-    for line in lines[1:]:
-        if line.startswith("Artist:"):
-            beatmap["artist"] = line.split(":")[1].strip()
-        elif line.startswith("Title:"):
-            beatmap["title"] = line.split(":")[1].strip()
-        elif line.startswith("Creator:"):
-            beatmap["creator"] = line.split(":")[1].strip()
-        elif line.startswith("Version:"):
-            beatmap["version"] = line.split(":")[1].strip()
-
-    return typing.cast(BeatmapMetadata, beatmap)
+    parser = BeatmapMetadataParser()
+    for offset in range(0, len(osu_file_bytes), PARSE_CHUNK_SIZE):
+        if parser.feed(osu_file_bytes[offset : offset + PARSE_CHUNK_SIZE]):
+            break
+
+    return parser.finish()
+
+
+def _parse_event_filename(event_params: str) -> str:
+    # filenames are usually quoted, and may then contain commas
+    if event_params.startswith('"'):
+        return event_params[1:].partition('"')[0]
+
+    return event_params.partition(",")[0].strip()
+
+
+def parse_background_and_metadata(
+    osu_file: typing.IO[bytes],
+) -> tuple[str | None, BeatmapMetadata]:
+    """Find the background image in a .osu file's [Events] section, and parse
+    its metadata, in a single pass.
+
+    The file is read line by line, and only until both have been found.
+    """
+    metadata_parser = BeatmapMetadataParser()
+    background_filename: str | None = None
+    events_parsed = False
+
+    section = None
+    for line_number, raw_line in enumerate(osu_file):
+        metadata_parsed = metadata_parser.feed(raw_line)
+        if events_parsed:
+            if metadata_parsed:
+                break
+            continue
+
+        encoding = "utf-8-sig" if line_number == 0 else "utf-8"
+        line = raw_line.decode(encoding, errors="replace").strip()
+
+        if line.startswith("[") and line.endswith("]"):
+            if section == "Events":
+                events_parsed = True
+            section = line[1:-1]
+            continue
+
+        if section != "Events" or line.startswith("//"):
+            continue
+
+        # background events look like `0,0,"bg.jpg",0,0`
+        event_type, _, event_params = line.partition(",")
+        if event_type.strip() in ("0", "Background"):
+            _, _, event_params = event_params.partition(",")
+            background_filename = _parse_event_filename(event_params.strip()) or None
+            events_parsed = True
+
+        if events_parsed and metadata_parsed:
+            break
+
+    return background_filename, metadata_parser.finish()
@@ -2,24 +2,20 @@ import io
 import logging
 
 import aiosu
-import httpx
 from aiosu.models.files import ReplayFile
 
-from app.common import settings
-
-
-score_service_http_client = httpx.AsyncClient(
-    base_url=settings.APP_SCORE_SERVICE_URL,
-)
+from app.adapters import upstream
+from app.common.cache import single_flight
 
 
 class Replay(ReplayFile):
     raw_replay_data: bytes
 
 
+@single_flight
 async def get_replay(score_id: int) -> Replay | None:
     try:
-        response = await score_service_http_client.get(f"/replays/{score_id}")
+        response = await upstream.get_client("scores").get(f"/replays/{score_id}")
         response.raise_for_status()
         osu_replay_data = response.read()
     except Exception:
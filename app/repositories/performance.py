@@ -1,8 +1,23 @@
+import asyncio
+import logging
+from typing import Any
 from typing import cast
 from typing import TypedDict
 
+import httpx
+
 from app import state
+from app.adapters import upstream
 from app.common import settings
+from app.common.batching import MicroBatcher
+from app.common.cache import CacheStats
+from app.common.cache import LRUCache
+from app.common.cache import SingleFlight
+
+# concurrent calculations are sent to the performance service together,
+# after waiting this long for others (in seconds), or once there are this many
+BATCH_DELAY = 0.005
+MAX_BATCH_SIZE = 32
 
 
 class Performance(TypedDict):
@@ -10,6 +25,209 @@ class Performance(TypedDict):
     stars: float
 
 
+class PerformanceRequest(TypedDict):
+    beatmap_md5: str
+    beatmap_id: int
+    mode: int
+    mods: int
+    max_combo: int
+    accuracy: float
+    miss_count: int
+
+
+async def _request_calculations(
+    requests: list[PerformanceRequest],
+) -> list[Performance | None]:
+    res = await upstream.get_client("performance").post(
+        "/api/v1/calculate",
+        json=requests,
+    )
+    res.raise_for_status()
+    resp = res.json()
+
+    if not isinstance(resp, list) or len(resp) != len(requests):
+        raise ValueError(
+            f"Expected {len(requests)} results from the performance service",
+        )
+
+    recs: list[Performance | None] = []
+    for result in resp:
+        if not result:
+            recs.append(None)
+            continue
+
+        if not isinstance(result, dict) or not {"pp", "stars"} <= result.keys():
+            raise ValueError(f"Invalid result from the performance service: {result}")
+
+        rec = {
+            "pp": result["pp"],
+            "stars": result["stars"],
+        }
+        recs.append(cast(Performance, rec))
+
+    return recs
+
+
+async def _request_calculation(request: PerformanceRequest) -> Performance | None:
+    try:
+        [performance] = await _request_calculations([request])
+    except (httpx.HTTPStatusError, ValueError):
+        logging.warning(
+            "Performance service rejected a calculation",
+            exc_info=True,
+            extra={"beatmap_md5": request["beatmap_md5"]},
+        )
+        return None
+
+    return performance
+
+
+async def fetch_many(
+    requests: list[PerformanceRequest],
+) -> list[Performance | None]:
+    """Calculate the performance of many scores, in a single request.
+
+    If the service rejects the request, e.g. over one score's inputs, each
+    score is retried on its own, so only the scores it rejects go without.
+    """
+    if not requests:
+        return []
+
+    if len(requests) == 1:
+        return [await _request_calculation(requests[0])]
+
+    try:
+        return await _request_calculations(requests)
+    except (httpx.HTTPStatusError, ValueError):
+        logging.warning(
+            "Performance service rejected a batch of calculations, retrying them individually",
+            exc_info=True,
+            extra={"batch_size": len(requests)},
+        )
+
+    return await asyncio.gather(*map(_request_calculation, requests))
+
+
+# (beatmap_md5, mode, mods, max_combo, accuracy, miss_count)
+PerformanceKey = tuple[str, int, int, int, float, int]
+
+# results only depend on their inputs, though expire as calculations change
+_cache: LRUCache[PerformanceKey, Performance] = LRUCache(
+    settings.PERFORMANCE_CACHE_SIZE,
+    ttl=settings.PERFORMANCE_CACHE_TTL,
+)
+
+_calculations: SingleFlight[PerformanceKey, Performance | None] = SingleFlight(
+    "app.repositories.performance.calculations",
+)
+
+_batcher: MicroBatcher[PerformanceRequest, Performance | None] = MicroBatcher(
+    fetch_many,
+    max_batch_size=MAX_BATCH_SIZE,
+    max_delay=BATCH_DELAY,
+)
+
+
+def _get_cache_key(request: PerformanceRequest) -> PerformanceKey:
+    # the beatmap's md5 identifies its exact version, so its id isn't needed
+    return (
+        request["beatmap_md5"],
+        request["mode"],
+        request["mods"],
+        request["max_combo"],
+        request["accuracy"],
+        request["miss_count"],
+    )
+
+
+def _get_query_params(request: PerformanceRequest) -> dict[str, Any]:
+    return {
+        "beatmap_md5": request["beatmap_md5"],
+        "mode": request["mode"],
+        "mods": request["mods"],
+        "max_combo": request["max_combo"],
+        "accuracy": request["accuracy"],
+        "miss_count": request["miss_count"],
+    }
+
+
+async def _fetch_persisted(request: PerformanceRequest) -> Performance | None:
+    query = """\
+        SELECT pp, stars
+        FROM performance_results
+        WHERE beatmap_md5 = :beatmap_md5
+        AND mode = :mode
+        AND mods = :mods
+        AND max_combo = :max_combo
+        AND accuracy = :accuracy
+        AND miss_count = :miss_count
+        AND created_at > NOW() - MAKE_INTERVAL(secs => :ttl)
+    """
+    params = _get_query_params(request) | {"ttl": settings.PERFORMANCE_CACHE_TTL}
+
+    try:
+        rec = await state.read_database.fetch_one(query, params)
+    except Exception:
+        logging.warning(
+            "Failed to fetch persisted performance result",
+            exc_info=True,
+            extra={"beatmap_md5": request["beatmap_md5"]},
+        )
+        return None
+
+    if rec is None:
+        return None
+
+    return cast(Performance, {"pp": rec["pp"], "stars": rec["stars"]})
+
+
+async def _persist(request: PerformanceRequest, performance: Performance) -> None:
+    query = """\
+        INSERT INTO performance_results (
+            beatmap_md5, mode, mods, max_combo, accuracy, miss_count, pp, stars
+        )
+        VALUES (
+            :beatmap_md5, :mode, :mods, :max_combo, :accuracy, :miss_count, :pp, :stars
+        )
+        ON CONFLICT (beatmap_md5, mode, mods, max_combo, accuracy, miss_count)
+        DO UPDATE SET pp = EXCLUDED.pp, stars = EXCLUDED.stars, created_at = NOW()
+    """
+    params = _get_query_params(request) | {
+        "pp": performance["pp"],
+        "stars": performance["stars"],
+    }
+
+    try:
+        await state.write_database.execute(query, params)
+    except Exception:
+        logging.warning(
+            "Failed to persist performance result",
+            exc_info=True,
+            extra={"beatmap_md5": request["beatmap_md5"]},
+        )
+
+
+async def _calculate(
+    request: PerformanceRequest,
+    cache_key: PerformanceKey,
+) -> Performance | None:
+    if settings.PERFORMANCE_CACHE_PERSIST:
+        performance = await _fetch_persisted(request)
+        if performance is not None:
+            _cache.set(cache_key, performance)
+            return performance
+
+    performance = await _batcher.submit(request)
+    if performance is None:
+        return None
+
+    _cache.set(cache_key, performance)
+    if settings.PERFORMANCE_CACHE_PERSIST:
+        await _persist(request, performance)
+
+    return performance
+
+
 async def fetch_one(
     beatmap_md5: str,
     beatmap_id: int,
@@ -19,28 +237,55 @@ async def fetch_one(
     accuracy: float,
     miss_count: int,
 ) -> Performance | None:
-    res = await state.http_client.post(
-        f"{settings.APP_PERFORMANCE_URL}/api/v1/calculate",
-        json=[
-            {
-                "beatmap_md5": beatmap_md5,
-                "beatmap_id": beatmap_id,
-                "mode": mode,
-                "mods": mods,
-                "max_combo": max_combo,
-                "accuracy": accuracy,
-                "miss_count": miss_count,
-            },
-        ],
+    """Calculate the performance of a score.
+
+    Results are cached in memory (and optionally the database) by their
+    inputs. Concurrent calculations with the same inputs share one result,
+    and different ones made concurrently are batched into one request.
+    """
+    request: PerformanceRequest = {
+        "beatmap_md5": beatmap_md5,
+        "beatmap_id": beatmap_id,
+        "mode": mode,
+        "mods": mods,
+        "max_combo": max_combo,
+        "accuracy": accuracy,
+        "miss_count": miss_count,
+    }
+    cache_key = _get_cache_key(request)
+
+    performance = _cache.get(cache_key)
+    if performance is not None:
+        return performance
+
+    return await _calculations.do(
+        cache_key,
+        lambda: _calculate(request, cache_key),
     )
-    resp = res.json()
 
-    if not resp:
-        return None
 
-    rec = {
-        "pp": resp[0]["pp"],
-        "stars": resp[0]["stars"],
-    }
+async def invalidate_beatmap(beatmap_md5: str) -> None:
+    """Forget every performance result calculated for a replaced beatmap version."""
+    for cache_key in _cache.keys():
+        if cache_key[0] == beatmap_md5:
+            _cache.delete(cache_key)
+
+    if not settings.PERFORMANCE_CACHE_PERSIST:
+        return
+
+    query = """\
+        DELETE FROM performance_results
+        WHERE beatmap_md5 = :beatmap_md5
+    """
+    try:
+        await state.write_database.execute(query, {"beatmap_md5": beatmap_md5})
+    except Exception:
+        logging.warning(
+            "Failed to invalidate persisted performance results",
+            exc_info=True,
+            extra={"beatmap_md5": beatmap_md5},
+        )
+
 
-    return cast(Performance, rec)
+def get_cache_stats() -> CacheStats:
+    return _cache.stats()
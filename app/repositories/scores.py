@@ -1,8 +1,8 @@
 from typing import cast
 from typing import TypedDict
 
-from app import state
-from app.common import settings
+from app.adapters import upstream
+from app.common.cache import single_flight
 
 
 class User(TypedDict):
@@ -41,9 +41,11 @@ class Score(TypedDict):
     rank: str
 
 
+@single_flight
 async def fetch_one(score_id: int, relax: int) -> Score | None:
-    res = await state.http_client.get(
-        f"{settings.APP_API_URL}/v1/score?id={score_id}&rx={relax}",
+    res = await upstream.hedged_get(
+        "api",
+        f"/v1/score?id={score_id}&rx={relax}",
     )
     resp = res.json()
 
@@ -1,7 +1,8 @@
 from typing import cast
 from typing import TypedDict
 
-from app import state
+from app.adapters import upstream
+from app.common.cache import single_flight
 
 
 class User(TypedDict):
@@ -9,9 +10,10 @@ class User(TypedDict):
     username: str
 
 
+@single_flight
 async def fetch_one(_type: str, user_id: int | str) -> User | None:
-    res = await state.http_client.get(
-        f"https://akatsuki.gg/api/v1/users/full?{_type}={user_id}",
+    res = await upstream.get_client("website").get(
+        f"/api/v1/users/full?{_type}={user_id}",
     )
     resp = res.json()
 
@@ -1,16 +1,17 @@
 from __future__ import annotations
 
+from concurrent.futures import ProcessPoolExecutor
 from typing import TYPE_CHECKING
 
-from httpx import AsyncClient
-
 if TYPE_CHECKING:
     from app.adapters.database import Database
     from app.adapters.webdriver import WebDriver
+    from app.common.templates import TemplateEngine
     from types_aiobotocore_s3.client import S3Client
 
 read_database: Database
 write_database: Database
-http_client: AsyncClient
 webdriver: WebDriver
+image_process_pool: ProcessPoolExecutor
+templates: TemplateEngine
 s3_client: S3Client
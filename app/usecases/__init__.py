@@ -1,2 +1,5 @@
+from . import backgrounds
+from . import beatmap_files
 from . import postprocessing
 from . import scorewatch
+from . import thumbnails
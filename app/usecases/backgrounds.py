@@ -0,0 +1,187 @@
+import asyncio
+import functools
+import logging
+import tempfile
+import typing
+import zipfile
+
+from app import osu_beatmaps
+from app.common import settings
+from app.common.cache import CacheStats
+from app.common.cache import DiskCache
+from app.common.cache import LRUCache
+from app.usecases import postprocessing
+
+# .osz files are held in memory up to this size while downloading, then on disk
+OSZ_SPOOL_SIZE = 8 * 1024 * 1024
+
+# skip (possibly malicious) archive members which inflate to more than this
+MAX_BACKGROUND_FILE_SIZE = 32 * 1024 * 1024
+
+# processed backgrounds, bounded by their total size in bytes
+_memory_cache: LRUCache[str, bytes] = LRUCache(
+    settings.BACKGROUND_CACHE_MEMORY_SIZE,
+    get_size=len,
+)
+
+
+@functools.cache
+def _get_disk_cache() -> DiskCache:
+    return DiskCache(
+        settings.BACKGROUND_CACHE_DIRECTORY,
+        settings.BACKGROUND_CACHE_DISK_SIZE,
+    )
+
+
+def _read_from_disk(cache_key: str) -> bytes | None:
+    return _get_disk_cache().get(cache_key)
+
+
+def _write_to_disk(cache_key: str, background_image_data: bytes) -> None:
+    _get_disk_cache().set(cache_key, background_image_data)
+
+
+def _get_cache_key(beatmap_id: int, effect_chain: postprocessing.EffectChain) -> str:
+    return f"{beatmap_id}:{effect_chain.name}:{postprocessing.PIPELINE_VERSION}"
+
+
+def _normalise_path(path: str) -> str:
+    return path.replace("\\", "/").strip("/").lower()
+
+
+def _find_background_member(
+    osz_file: zipfile.ZipFile,
+    beatmap_id: int,
+) -> zipfile.ZipInfo | None:
+    members = {_normalise_path(info.filename): info for info in osz_file.infolist()}
+
+    background_filenames: dict[int | None, str] = {}
+    for info in osz_file.infolist():
+        if not info.filename.lower().endswith(".osu"):
+            continue
+
+        # only reads the start of the .osu file, up to its background
+        with osz_file.open(info) as osu_file:
+            background_filename, beatmap_metadata = (
+                osu_beatmaps.parse_background_and_metadata(osu_file)
+            )
+        if background_filename is None:
+            continue
+
+        background_filenames[beatmap_metadata["beatmap_id"]] = background_filename
+
+    background_filename = background_filenames.get(beatmap_id)
+    if background_filename is None:
+        # older beatmaps lack ids, but their difficulties usually share a background
+        if len(set(background_filenames.values())) != 1:
+            return None
+
+        background_filename = next(iter(background_filenames.values()))
+
+    return members.get(_normalise_path(background_filename))
+
+
+def _extract_background_from_osz(
+    osz_file: typing.IO[bytes],
+    beatmap_id: int,
+) -> bytes | None:
+    """Extract a beatmap's background image from its beatmapset's .osz file.
+
+    Only the archive's central directory, the start of its .osu files and the
+    background image itself are ever read & decompressed.
+    """
+    try:
+        with zipfile.ZipFile(osz_file) as osz:
+            background_member = _find_background_member(osz, beatmap_id)
+            if background_member is None:
+                return None
+
+            if background_member.file_size > MAX_BACKGROUND_FILE_SIZE:
+                logging.warning(
+                    "Background image in .osz file is too large",
+                    extra={
+                        "beatmap_id": beatmap_id,
+                        "file_size": background_member.file_size,
+                    },
+                )
+                return None
+
+            return osz.read(background_member)
+    except Exception:
+        # besides corrupt archives, zipfile raises NotImplementedError for
+        # unsupported compression methods & RuntimeError for encrypted members
+        logging.warning(
+            "Failed to extract background image from .osz file",
+            exc_info=True,
+            extra={"beatmap_id": beatmap_id},
+        )
+        return None
+
+
+async def _get_background_from_osz(
+    beatmap_id: int,
+    beatmapset_id: int,
+) -> bytes | None:
+    with tempfile.SpooledTemporaryFile(max_size=OSZ_SPOOL_SIZE) as osz_file:
+        if not await osu_beatmaps.download_osz_file(beatmapset_id, osz_file):
+            return None
+
+        return await asyncio.to_thread(
+            _extract_background_from_osz,
+            osz_file,
+            beatmap_id,
+        )
+
+
+async def get_processed_background(
+    beatmap_id: int,
+    effect_chain: postprocessing.EffectChain,
+    beatmapset_id: int | None = None,
+) -> bytes | str:
+    """Get a beatmap's background, with a template's effects applied & encoded.
+
+    Processed backgrounds only depend on the beatmap & template, so they're
+    cached in memory & on disk, before fetching from the beatmaps-service.
+    When the service has no background for the beatmap, it's extracted from
+    the beatmapset's .osz file instead.
+    """
+    cache_key = _get_cache_key(beatmap_id, effect_chain)
+
+    background_image_data = _memory_cache.get(cache_key)
+    if background_image_data is not None:
+        return background_image_data
+
+    background_image_data = await asyncio.to_thread(_read_from_disk, cache_key)
+    if background_image_data is not None:
+        _memory_cache.set(cache_key, background_image_data)
+        return background_image_data
+
+    background_image_contents = (
+        await osu_beatmaps.get_beatmap_background_image_contents(beatmap_id)
+    )
+    if not background_image_contents and beatmapset_id is not None:
+        background_image_contents = await _get_background_from_osz(
+            beatmap_id,
+            beatmapset_id,
+        )
+    if not background_image_contents:
+        return "Couldn't find beatmap associated with this score!"
+
+    # decoding, effects & encoding all happen in an image worker process
+    background_image_data = await postprocessing.process_image_in_worker(
+        background_image_contents,
+        effect_chain,
+    )
+    if background_image_data is None:
+        return "Couldn't process the background image of this beatmap!"
+
+    _memory_cache.set(cache_key, background_image_data)
+    await asyncio.to_thread(_write_to_disk, cache_key, background_image_data)
+    return background_image_data
+
+
+def get_cache_stats() -> dict[str, CacheStats]:
+    return {
+        "memory": _memory_cache.stats(),
+        "disk": _get_disk_cache().stats(),
+    }
@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import hashlib
+import logging
+import zlib
+
+from app import osu_beatmaps
+from app.common import settings
+from app.common.cache import CacheStats
+from app.common.cache import DiskCache
+from app.common.cache import LRUCache
+from app.common.cache import SingleFlight
+from app.repositories import performance
+
+# .osu files, bounded by their total (uncompressed) size in bytes
+_memory_cache: LRUCache[str, bytes] = LRUCache(
+    settings.OSU_FILE_CACHE_MEMORY_SIZE,
+    get_size=len,
+)
+
+# parsed .osu file metadata, by beatmap md5
+_metadata_cache: LRUCache[str, osu_beatmaps.BeatmapMetadata] = LRUCache(
+    settings.BEATMAP_METADATA_CACHE_SIZE,
+)
+
+# the md5 of the version of each beatmap the beatmaps-service last served
+_current_beatmap_md5s: LRUCache[int, str] = LRUCache(
+    settings.BEATMAP_METADATA_CACHE_SIZE,
+)
+
+_osu_file_fetches: SingleFlight[str, bytes | None] = SingleFlight(
+    "app.usecases.beatmap_files.osu_file_fetches",
+)
+_metadata_fetches: SingleFlight[str, osu_beatmaps.BeatmapMetadata | None] = (
+    SingleFlight("app.usecases.beatmap_files.metadata_fetches")
+)
+
+
+@functools.cache
+def _get_disk_cache() -> DiskCache:
+    return DiskCache(
+        settings.OSU_FILE_CACHE_DIRECTORY,
+        settings.OSU_FILE_CACHE_DISK_SIZE,
+    )
+
+
+def _read_from_disk(beatmap_md5: str) -> bytes | None:
+    compressed_contents = _get_disk_cache().get(beatmap_md5)
+    if compressed_contents is None:
+        return None
+
+    try:
+        return zlib.decompress(compressed_contents)
+    except zlib.error:
+        logging.warning(
+            "Failed to decompress cached .osu file",
+            exc_info=True,
+            extra={"beatmap_md5": beatmap_md5},
+        )
+        return None
+
+
+def _write_to_disk(beatmap_md5: str, osu_file_contents: bytes) -> None:
+    _get_disk_cache().set(beatmap_md5, zlib.compress(osu_file_contents))
+
+
+async def _fetch_osu_file_contents(beatmap_id: int, beatmap_md5: str) -> bytes | None:
+    osu_file_contents = await asyncio.to_thread(_read_from_disk, beatmap_md5)
+    if osu_file_contents is not None:
+        _memory_cache.set(beatmap_md5, osu_file_contents)
+        return osu_file_contents
+
+    osu_file_contents = await osu_beatmaps.get_osu_file_contents(beatmap_id)
+    if osu_file_contents is None:
+        return None
+
+    # the beatmaps-service serves the latest version of a beatmap, which may
+    # have been updated since; only cache files under the md5 they really have.
+    actual_beatmap_md5 = hashlib.md5(osu_file_contents).hexdigest()
+    if actual_beatmap_md5 != beatmap_md5:
+        logging.info(
+            "Fetched .osu file is a different version of the beatmap",
+            extra={
+                "beatmap_id": beatmap_id,
+                "beatmap_md5": beatmap_md5,
+                "actual_beatmap_md5": actual_beatmap_md5,
+            },
+        )
+
+    # results for an outdated version are still right for its scores, so only
+    # forget them once the beatmap's been updated, not on every stale request
+    previous_beatmap_md5 = _current_beatmap_md5s.get(beatmap_id)
+    _current_beatmap_md5s.set(beatmap_id, actual_beatmap_md5)
+    if previous_beatmap_md5 is not None and previous_beatmap_md5 != actual_beatmap_md5:
+        logging.info(
+            "Beatmap has been updated, invalidating its previous version",
+            extra={
+                "beatmap_id": beatmap_id,
+                "previous_beatmap_md5": previous_beatmap_md5,
+                "beatmap_md5": actual_beatmap_md5,
+            },
+        )
+        await performance.invalidate_beatmap(previous_beatmap_md5)
+
+    _memory_cache.set(actual_beatmap_md5, osu_file_contents)
+    await asyncio.to_thread(_write_to_disk, actual_beatmap_md5, osu_file_contents)
+    return osu_file_contents
+
+
+async def get_osu_file_contents(beatmap_id: int, beatmap_md5: str) -> bytes | None:
+    """Get the .osu file of a specific version of a beatmap.
+
+    Files are content-addressed by their md5, so cached files never go stale.
+    They're cached in memory & compressed on disk, and concurrent requests for
+    the same file share a single fetch from the beatmaps-service.
+    """
+    osu_file_contents = _memory_cache.get(beatmap_md5)
+    if osu_file_contents is not None:
+        return osu_file_contents
+
+    return await _osu_file_fetches.do(
+        beatmap_md5,
+        lambda: _fetch_osu_file_contents(beatmap_id, beatmap_md5),
+    )
+
+
+async def _fetch_beatmap_metadata(
+    beatmap_id: int,
+    beatmap_md5: str,
+) -> osu_beatmaps.BeatmapMetadata | None:
+    osu_file_contents = await get_osu_file_contents(beatmap_id, beatmap_md5)
+    if osu_file_contents is None:
+        return None
+
+    beatmap_metadata = osu_beatmaps.parse_beatmap_metadata(osu_file_contents)
+
+    # the beatmaps-service may have served a different version of the beatmap,
+    # so only cache metadata under the md5 its file really has.
+    actual_beatmap_md5 = hashlib.md5(osu_file_contents).hexdigest()
+    _metadata_cache.set(actual_beatmap_md5, beatmap_metadata)
+    return beatmap_metadata
+
+
+async def get_beatmap_metadata(
+    beatmap_id: int,
+    beatmap_md5: str,
+) -> osu_beatmaps.BeatmapMetadata | None:
+    """Get the metadata of a specific version of a beatmap.
+
+    Metadata is parsed from the version's .osu file, which is cached (see
+    `get_osu_file_contents`), so fetching it also warms the file cache.
+    """
+    beatmap_metadata = _metadata_cache.get(beatmap_md5)
+    if beatmap_metadata is not None:
+        return beatmap_metadata
+
+    return await _metadata_fetches.do(
+        beatmap_md5,
+        lambda: _fetch_beatmap_metadata(beatmap_id, beatmap_md5),
+    )
+
+
+def get_cache_stats() -> dict[str, CacheStats]:
+    return {
+        "memory": _memory_cache.stats(),
+        "disk": _get_disk_cache().stats(),
+        "metadata": _metadata_cache.stats(),
+    }
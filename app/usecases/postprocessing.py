@@ -1,14 +1,81 @@
+import asyncio
+import functools
+import io
+import logging
+import math
+import multiprocessing
+import threading
+import time
+import typing
 from collections.abc import Callable
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
 
-import blend_modes
 import numpy as np
 import numpy.typing as npt
 from PIL import Image
-from PIL import ImageDraw
-from PIL import ImageEnhance
 from PIL import ImageFilter
 from PIL import ImageOps
 
+from app import logger
+from app import state
+
+# NOTE: bump whenever the output of the effects below changes,
+# so that previously cached thumbnails are no longer used.
+PIPELINE_VERSION = 4
+
+BACKGROUND_SIZE = (1920, 1080)
+
+# images with more pixels than this are refused before being decoded,
+# unless they are jpegs which can be decoded at a reduced scale instead.
+MAX_IMAGE_PIXELS = 40_000_000
+
+
+class ResizeEffect(typing.TypedDict):
+    effect: typing.Literal["resize"]
+    size: tuple[int, int]
+
+
+class ShadingEffect(typing.TypedDict):
+    effect: typing.Literal["shading"]
+    colour: tuple[int, int, int]
+    opacity: float
+
+
+class SaturationEffect(typing.TypedDict):
+    effect: typing.Literal["saturation"]
+    colour: tuple[int, int, int]
+    opacity: float
+
+
+class BrightnessEffect(typing.TypedDict):
+    effect: typing.Literal["brightness"]
+    # the area within these offsets is left untouched
+    offsets: tuple[int, int, int, int]
+    factor: float
+
+
+class GaussianBlurEffect(typing.TypedDict):
+    effect: typing.Literal["gaussian_blur"]
+    # the area within these offsets is left untouched
+    offsets: tuple[int, int, int, int]
+    radius: int
+
+
+Effect = (
+    ResizeEffect
+    | ShadingEffect
+    | SaturationEffect
+    | BrightnessEffect
+    | GaussianBlurEffect
+)
+PixelwiseEffect = ShadingEffect | SaturationEffect | BrightnessEffect
+
+
+class StageTiming(typing.TypedDict):
+    stage: str
+    duration_ms: float
+
 
 def _ensure_image(image: str | Image.Image) -> Image.Image:
     """Ensure image is Image.Image."""
@@ -21,40 +88,192 @@ def _ensure_image(image: str | Image.Image) -> Image.Image:
     return im
 
 
-def _create_offset_mask(
+def load_image(
+    image_data: bytes,
+    size: tuple[int, int] | None = None,
+) -> Image.Image | None:
+    """Decode an rgb image at the smallest scale which can still cover `size`.
+
+    Jpegs are decoded straight at 1/2, 1/4 or 1/8 scale where possible,
+    other formats are cheaply reduced by an integer factor after decoding.
+    """
+    try:
+        im = Image.open(io.BytesIO(image_data))
+
+        # the smallest size which still covers `size` once cropped to its ratio
+        cover_size = im.size
+        if size is not None:
+            scale = max(size[0] / im.width, size[1] / im.height)
+            cover_size = (math.ceil(im.width * scale), math.ceil(im.height * scale))
+
+        if im.format == "JPEG":
+            im.draft("RGB", cover_size)
+
+        if im.width * im.height > MAX_IMAGE_PIXELS:
+            logging.warning(
+                "Refusing to decode oversized image",
+                extra={"format": im.format, "image_size": im.size},
+            )
+            return None
+
+        im.load()
+    except (OSError, ValueError, Image.DecompressionBombError):
+        logging.warning("Failed to decode image", exc_info=True)
+        return None
+
+    reduce_factor = min(im.width // cover_size[0], im.height // cover_size[1])
+    if reduce_factor > 1:
+        im = im.reduce(reduce_factor)
+
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+
+    return im
+
+
+def _get_unprotected_boxes(
     image_dim: tuple[int, int],
     offsets: tuple[int, int, int, int],
+) -> list[tuple[int, int, int, int]]:
+    """Split the area outside of the (inclusive) offsets into boxes."""
+
+    width, height = image_dim
+    left = max(offsets[0], 0)
+    top = max(offsets[1], 0)
+    right = min(offsets[2] + 1, width)
+    bottom = min(offsets[3] + 1, height)
+
+    if left >= right or top >= bottom:
+        return [(0, 0, width, height)]
+
+    boxes = [
+        (0, 0, width, top),
+        (0, bottom, width, height),
+        (0, top, left, bottom),
+        (right, top, width, bottom),
+    ]
+    return [box for box in boxes if box[0] < box[2] and box[1] < box[3]]
+
+
+T = typing.TypeVar("T")
+
+BlendMode = typing.Literal["multiply", "hard_light"]
+
+# per-thread working buffers, reused between effects rather than reallocated
+_buffers = threading.local()
+
+
+def _get_scratch_buffer(shape: tuple[int, ...]) -> npt.NDArray[np.float32]:
+    scratch: npt.NDArray[np.float32] | None = getattr(_buffers, "scratch", None)
+    if scratch is None or scratch.shape != shape:
+        scratch = np.empty(shape, dtype=np.float32)
+        _buffers.scratch = scratch
+
+    return scratch
+
+
+def _to_frame(image: Image.Image) -> npt.NDArray[np.float32]:
+    """Convert an image to a float32 rgb(a) frame, with values from 0 to 255."""
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+
+    return np.asarray(image, dtype=np.float32)
+
+
+def _from_frame(frame: npt.NDArray[np.float32]) -> Image.Image:
+    return Image.fromarray(frame.astype(np.uint8))
+
+
+def _blend_colour(
+    frame: npt.NDArray[np.float32],
+    colour: tuple[int, int, int],
+    opacity: float,
+    blend_mode: BlendMode,
+) -> None:
+    """Blend a solid colour layer onto a frame, in-place.
+
+    Equivalent to the blend functions of the `blend_modes` package with a
+    fully opaque layer, without ever materializing that layer.
+    """
+    layer = np.array(colour, dtype=np.float32) / 255
+
+    # against a constant colour, both blend modes reduce to
+    # min(pixel * scale + offset, 255) on each colour channel.
+    if blend_mode == "multiply":
+        scale = layer
+        offset = np.zeros(3, dtype=np.float32)
+    else:
+        scale = np.where(layer > 0.5, 2 - 2 * layer, 2 * layer)
+        offset = np.where(layer > 0.5, (2 * layer - 1) * 255, 0)
+
+    rgb = frame[:, :, :3]
+    alpha = frame[:, :, 3:] / 255
+
+    # how much of the blended colour to mix in, given the pixel's alpha
+    if frame.shape[2] == 3 or alpha.min() == 1:
+        ratio: float | npt.NDArray[np.float32] = opacity
+    else:
+        # fully transparent pixels are left as they are
+        ratio = np.divide(
+            alpha * opacity,
+            alpha + (1 - alpha) * alpha * opacity,
+            out=np.zeros_like(alpha),
+            where=alpha > 0,
+        )
+
+    blended = _get_scratch_buffer(rgb.shape)
+    np.multiply(rgb, scale, out=blended)
+    blended += offset
+    np.minimum(blended, 255, out=blended)
+
+    # rgb + (blended - rgb) * ratio
+    blended -= rgb
+    blended *= ratio
+    rgb += blended
+
+
+def _scale_brightness(
+    frame: npt.NDArray[np.float32],
+    offsets: tuple[int, int, int, int],
+    factor: float,
+) -> None:
+    """Scale the brightness of a frame outside of the offsets, in-place."""
+    height, width = frame.shape[:2]
+    for left, top, right, bottom in _get_unprotected_boxes((width, height), offsets):
+        region = frame[top:bottom, left:right, :3]
+        region *= factor
+        np.minimum(region, 255, out=region)
+
+
+def _apply_pixelwise_effects(
+    image: Image.Image,
+    effects: Sequence[PixelwiseEffect],
 ) -> Image.Image:
-    """Create offset mask to keep offseted area safe."""
+    """Apply a run of pixel-wise effects to a single float32 frame."""
 
-    mask = Image.new("L", image_dim, 0)
-    draw = ImageDraw.Draw(mask)
+    frame = _to_frame(image)
+    for effect in effects:
+        if effect["effect"] == "shading":
+            _blend_colour(frame, effect["colour"], effect["opacity"], "multiply")
+        elif effect["effect"] == "saturation":
+            _blend_colour(frame, effect["colour"], effect["opacity"], "hard_light")
+        else:
+            _scale_brightness(frame, effect["offsets"], effect["factor"])
 
-    draw.rectangle(offsets, fill=255)
-    return mask
+    return _from_frame(frame)
 
 
 def _apply_blend_mode(
     image: str | Image.Image,
     colour: tuple[int, int, int],
     opacity: float,
-    blend_mode: Callable[
-        [npt.NDArray[np.float32], npt.NDArray[np.float32], float],
-        npt.NDArray[np.float32],
-    ],
+    blend_mode: BlendMode,
 ) -> Image.Image:
     """Apply blend function to image."""
 
-    im = _ensure_image(image)
-    blend_layer = Image.new("RGBA", im.size, colour)
-
-    layer_float = np.array(im).astype(float)
-    blend_layer_float = np.array(blend_layer).astype(float)
-
-    blended_float = blend_mode(layer_float, blend_layer_float, opacity)
-
-    blend_img = Image.fromarray(np.uint8(blended_float))
-    return blend_img
+    frame = _to_frame(_ensure_image(image))
+    _blend_colour(frame, colour, opacity, blend_mode)
+    return _from_frame(frame)
 
 
 def resize_image(input_image: Image.Image, dimensions: tuple[int, int]) -> Image.Image:
@@ -68,7 +287,7 @@ def apply_shading(
     opacity: float,
 ) -> Image.Image:
     """Apply shading effect on layer."""
-    return _apply_blend_mode(image, colour, opacity, blend_modes.multiply)
+    return _apply_blend_mode(image, colour, opacity, "multiply")
 
 
 def apply_saturation(
@@ -77,7 +296,7 @@ def apply_saturation(
     opacity: float,
 ) -> Image.Image:
     """Apply saturation effect on layer."""
-    return _apply_blend_mode(image, colour, opacity, blend_modes.hard_light)
+    return _apply_blend_mode(image, colour, opacity, "hard_light")
 
 
 def apply_new_brightness(
@@ -88,11 +307,10 @@ def apply_new_brightness(
     """Apply new brightness value to image."""
 
     im = _ensure_image(image)
-    mask = _create_offset_mask(im.size, offsets)
-    brightness = ImageEnhance.Brightness(im).enhance(opacity)
-
-    brightness.paste(im, mask=mask)
-    return brightness
+    return _apply_pixelwise_effects(
+        im,
+        [{"effect": "brightness", "offsets": offsets, "factor": opacity}],
+    )
 
 
 def apply_gaussian_blur(
@@ -103,10 +321,31 @@ def apply_gaussian_blur(
     """Apply gaussian filter to image."""
 
     im = _ensure_image(image)
-    mask = _create_offset_mask(im.size, offsets)
-    blurred = im.filter(ImageFilter.GaussianBlur(blur_radius))
+    blurred = im.copy()
+
+    # only filter the area which changes, plus enough of a margin
+    # around it for the blur to come out the same as on the full image.
+    margin = 3 * blur_radius + 4
+    for left, top, right, bottom in _get_unprotected_boxes(im.size, offsets):
+        padded_box = (
+            max(left - margin, 0),
+            max(top - margin, 0),
+            min(right + margin, im.width),
+            min(bottom + margin, im.height),
+        )
+        region = im.crop(padded_box).filter(ImageFilter.GaussianBlur(blur_radius))
+        blurred.paste(
+            region.crop(
+                (
+                    left - padded_box[0],
+                    top - padded_box[1],
+                    right - padded_box[0],
+                    bottom - padded_box[1],
+                ),
+            ),
+            (left, top),
+        )
 
-    blurred.paste(im, mask=mask)
     return blurred
 
 
@@ -119,18 +358,363 @@ def convert_to_jpg(image: str | Image.Image) -> Image.Image:
     return im
 
 
+_Stage = tuple[str, Callable[[Image.Image], Image.Image]]
+
+
+def _reorder_effects(effects: Sequence[Effect]) -> list[Effect]:
+    """Move colour blends after any blurs they precede.
+
+    On an opaque image, blending a constant colour is an affine map of each
+    channel which never clips, so it commutes with a blur. Grouping blends
+    together lets them share a single frame.
+    """
+    reordered: list[Effect] = []
+    pending_blends: list[Effect] = []
+    for effect in effects:
+        if effect["effect"] in ("shading", "saturation"):
+            pending_blends.append(effect)
+        elif effect["effect"] == "gaussian_blur":
+            reordered.append(effect)
+        else:
+            reordered.extend(pending_blends)
+            pending_blends.clear()
+            reordered.append(effect)
+
+    reordered.extend(pending_blends)
+    return reordered
+
+
+def _plan_stages(effects: Sequence[Effect], has_alpha: bool) -> list[_Stage]:
+    if not has_alpha:
+        effects = _reorder_effects(effects)
+
+    stages: list[_Stage] = []
+    pixelwise_effects: list[PixelwiseEffect] = []
+
+    def flush_pixelwise_effects() -> None:
+        if not pixelwise_effects:
+            return
+
+        run = list(pixelwise_effects)
+        name = "+".join(effect["effect"] for effect in run)
+        stages.append(
+            (name, functools.partial(_apply_pixelwise_effects, effects=run)),
+        )
+        pixelwise_effects.clear()
+
+    for effect in effects:
+        if (
+            effect["effect"] == "shading"
+            or effect["effect"] == "saturation"
+            or effect["effect"] == "brightness"
+        ):
+            pixelwise_effects.append(effect)
+            continue
+
+        flush_pixelwise_effects()
+        # bind each stage's arguments now, not when the stage is applied
+        if effect["effect"] == "resize":
+            stages.append(
+                (
+                    "resize",
+                    functools.partial(resize_image, dimensions=effect["size"]),
+                ),
+            )
+        else:
+            stages.append(
+                (
+                    "gaussian_blur",
+                    functools.partial(
+                        apply_gaussian_blur,
+                        offsets=effect["offsets"],
+                        blur_radius=effect["radius"],
+                    ),
+                ),
+            )
+
+    flush_pixelwise_effects()
+    return stages
+
+
+class EffectChain:
+    """A template's background effects, declared as data.
+
+    The effects are planned into stages before being applied: runs of
+    pixel-wise effects share one float32 frame, and masked effects only
+    touch the area they change.
+    """
+
+    def __init__(self, name: str, effects: Sequence[Effect]) -> None:
+        self.name = name
+        self.effects = list(effects)
+
+        self._plans: dict[bool, list[_Stage]] = {}
+
+    def __reduce__(self) -> tuple[typing.Any, ...]:
+        # only send the declaration to image workers, they plan it themselves
+        return (EffectChain, (self.name, self.effects))
+
+    @property
+    def output_size(self) -> tuple[int, int] | None:
+        """The size of the image once resized, if the chain resizes it."""
+        for effect in reversed(self.effects):
+            if effect["effect"] == "resize":
+                return effect["size"]
+
+        return None
+
+    def plan(self, has_alpha: bool) -> list[_Stage]:
+        if has_alpha not in self._plans:
+            self._plans[has_alpha] = _plan_stages(self.effects, has_alpha)
+
+        return self._plans[has_alpha]
+
+    def apply_with_timings(
+        self,
+        image: Image.Image,
+    ) -> tuple[Image.Image, list[StageTiming]]:
+        timings: list[StageTiming] = []
+        for stage_name, apply_stage in self.plan("A" in image.getbands()):
+            started_at = time.perf_counter()
+            image = apply_stage(image)
+            timings.append(
+                {
+                    "stage": stage_name,
+                    "duration_ms": round((time.perf_counter() - started_at) * 1000, 2),
+                },
+            )
+
+        return image, timings
+
+    def apply(self, image: Image.Image) -> Image.Image:
+        image, timings = self.apply_with_timings(image)
+        logging.info(
+            "Applied background effects",
+            extra={"effect_chain": self.name, "stage_timings": timings},
+        )
+        return image
+
+
+NORMAL_TEMPLATE_EFFECTS = EffectChain(
+    "normal",
+    [{"effect": "resize", "size": BACKGROUND_SIZE}],
+)
+
+KNOCKOUT_TEMPLATE_EFFECTS = EffectChain(
+    "knockout",
+    [
+        {"effect": "resize", "size": BACKGROUND_SIZE},
+        {"effect": "shading", "colour": (0, 0, 0), "opacity": 0.10},
+        {"effect": "gaussian_blur", "offsets": (0, 0, 1920, 0), "radius": 3},
+        {"effect": "saturation", "colour": (13, 13, 97), "opacity": 0.10},
+    ],
+)
+
+
 def apply_effects_normal_template(input_image: Image.Image) -> Image.Image:
     """Apply effects for normal score template."""
 
-    return resize_image(input_image, (1920, 1080))
+    return NORMAL_TEMPLATE_EFFECTS.apply(input_image)
 
 
 def apply_effects_knockout_template(input_image: Image.Image) -> Image.Image:
     """Apply effects for knockout template."""
 
-    im = resize_image(input_image, (1920, 1080))
-    im1 = apply_shading(im, (0, 0, 0), 0.10)
-    im2 = apply_gaussian_blur(im1, (0, 0, 1920, 0), 3)
-    im3 = apply_saturation(im2, (13, 13, 97), 0.10)
-
-    return im3
+    return KNOCKOUT_TEMPLATE_EFFECTS.apply(input_image)
+
+
+# NOTE: keep in sync with `THUMBNAIL_IMAGE_FORMAT` in app/common/settings.py
+ImageFormat = typing.Literal["jpeg", "webp"]
+
+FILE_EXTENSIONS: dict[ImageFormat, str] = {"jpeg": "jpg", "webp": "webp"}
+
+# the lowest quality a size-targeted encode will go down to
+MIN_QUALITY = 50
+
+
+class EncodeOptions(typing.TypedDict):
+    image_format: ImageFormat
+    # when set, the highest quality which fits within this many bytes is used
+    max_size: int | None
+    # the width of the preview, which keeps the image's aspect ratio
+    preview_width: int
+
+
+class EncodedImages(typing.TypedDict):
+    image_data: bytes
+    preview_image_data: bytes
+
+
+def _encode_image_at_quality(
+    image: Image.Image,
+    image_format: ImageFormat,
+    quality: int,
+    progressive: bool,
+) -> bytes:
+    with io.BytesIO() as output_buffer:
+        if image_format == "jpeg":
+            jpeg_options: dict[str, typing.Any] = {
+                "quality": quality,
+                "progressive": progressive,
+                # keep full colour resolution, for crisp coloured text
+                "subsampling": 0 if quality >= 90 else 2,
+            }
+            try:
+                image.save(output_buffer, format="JPEG", optimize=True, **jpeg_options)
+            except OSError:
+                # pillow sizes the buffer optimized jpegs are written through
+                # by their pixel count, which very noisy images can outgrow.
+                output_buffer.seek(0)
+                output_buffer.truncate()
+                image.save(output_buffer, format="JPEG", **jpeg_options)
+        else:
+            image.save(output_buffer, format="WEBP", quality=quality, method=4)
+
+        return output_buffer.getvalue()
+
+
+def encode_image(
+    image: Image.Image,
+    image_format: ImageFormat = "jpeg",
+    quality: int = 95,
+    max_size: int | None = None,
+    progressive: bool = False,
+) -> bytes:
+    """Encode an image, at up to `quality` while fitting within `max_size` bytes.
+
+    Progressive jpegs show a full low-detail image while still downloading,
+    at roughly twice the encoding time of a baseline jpeg.
+    """
+
+    image_data = _encode_image_at_quality(image, image_format, quality, progressive)
+    if max_size is None or len(image_data) <= max_size:
+        return image_data
+
+    # binary search for the highest quality which still fits
+    best_image_data = None
+    low, high = MIN_QUALITY, quality - 1
+    while low <= high:
+        middle = (low + high) // 2
+        candidate = _encode_image_at_quality(image, image_format, middle, progressive)
+        if len(candidate) <= max_size:
+            best_image_data = candidate
+            low = middle + 1
+        else:
+            high = middle - 1
+
+    if best_image_data is None:
+        logging.warning(
+            "Image does not fit within its size budget at the minimum quality",
+            extra={"max_size": max_size, "min_quality": MIN_QUALITY},
+        )
+        best_image_data = _encode_image_at_quality(
+            image,
+            image_format,
+            MIN_QUALITY,
+            progressive,
+        )
+
+    return best_image_data
+
+
+def encode_image_with_preview(
+    image: Image.Image,
+    encode_options: EncodeOptions,
+) -> EncodedImages:
+    """Encode an image at full resolution, along with a small preview of it."""
+
+    preview_width = min(encode_options["preview_width"], image.width)
+    preview_height = round(image.height * preview_width / image.width)
+    # box-reduce by the whole factor first, it's a fraction of lanczos' cost
+    preview_image = image.resize(
+        (preview_width, preview_height),
+        Image.Resampling.LANCZOS,
+        reducing_gap=1.0,
+    )
+
+    return {
+        "image_data": encode_image(
+            image,
+            encode_options["image_format"],
+            quality=95,
+            max_size=encode_options["max_size"],
+        ),
+        "preview_image_data": encode_image(
+            preview_image,
+            encode_options["image_format"],
+            quality=80,
+            progressive=True,
+        ),
+    }
+
+
+def reencode_image_with_preview(
+    image_data: bytes,
+    encode_options: EncodeOptions,
+) -> EncodedImages | None:
+    image = load_image(image_data)
+    if image is None:
+        return None
+
+    return encode_image_with_preview(image, encode_options)
+
+
+def process_image(
+    image_data: bytes,
+    effect_chain: EffectChain,
+    image_format: ImageFormat = "jpeg",
+    quality: int = 95,
+) -> bytes | None:
+    """Decode an image, apply an effect chain to it & encode the result."""
+
+    image = load_image(image_data, effect_chain.output_size)
+    if image is None:
+        return None
+
+    image = effect_chain.apply(image)
+    return encode_image(image, image_format, quality)
+
+
+def _warm_up_image_worker() -> None:
+    # unpickling this function has imported everything workers need
+    pass
+
+
+def create_image_process_pool(max_workers: int) -> ProcessPoolExecutor:
+    # spawn workers rather than forking them, as the bot runs other threads
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=logger.configure_logging,
+    )
+
+
+def warm_up_image_process_pool(pool: ProcessPoolExecutor, max_workers: int) -> None:
+    """Start every image worker up front, so renders don't wait on them booting."""
+    futures = [pool.submit(_warm_up_image_worker) for _ in range(max_workers)]
+    for future in futures:
+        future.result()
+
+
+async def run_in_image_worker(
+    func: Callable[..., T],
+    *args: typing.Any,
+) -> T:
+    """Run cpu-bound image work in the image process pool, off the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(state.image_process_pool, func, *args)
+
+
+async def process_image_in_worker(
+    image_data: bytes,
+    effect_chain: EffectChain,
+    image_format: ImageFormat = "jpeg",
+    quality: int = 95,
+) -> bytes | None:
+    return await run_in_image_worker(
+        process_image,
+        image_data,
+        effect_chain,
+        image_format,
+        quality,
+    )
@@ -1,28 +1,46 @@
+from __future__ import annotations
+
+import asyncio
+import base64
 import datetime
-import io
-import os
-import tempfile
+import hashlib
+import html
+import json
+import logging
+import time
 import typing
+from collections.abc import Awaitable
 
 import aiosu
 import discord
 from aiosu.models.mods import Mod
 from discord.ext import commands
-from PIL import Image
 
 from app import osu
+from app import osu_avatars
 from app import osu_beatmaps
 from app import state
+from app.adapters import assets
 from app.adapters import aws_s3
+from app.adapters import upstream
+from app.adapters import webdriver
+from app.common import settings
+from app.common import templates
+from app.common.cache import LRUCache
 from app.constants import Status
 from app.repositories import performance
 from app.repositories.scores import Score
 from app.repositories.sw_requests import ScorewatchRequest
+from app.usecases import backgrounds
+from app.usecases import beatmap_files
 from app.usecases import postprocessing
+from app.usecases import thumbnails
 
 RELAX_OFFSET = 500000000
 AP_OFFSET = 6148914691236517204
 
+T = typing.TypeVar("T")
+
 
 def get_relax_from_score_id(score_id: int) -> int:
     if score_id < RELAX_OFFSET:
@@ -89,10 +107,369 @@ async def format_request_embed(
     return embed
 
 
+def _get_encode_options() -> postprocessing.EncodeOptions:
+    return {
+        "image_format": typing.cast(
+            postprocessing.ImageFormat,
+            settings.THUMBNAIL_IMAGE_FORMAT,
+        ),
+        "max_size": settings.THUMBNAIL_MAX_SIZE,
+        "preview_width": settings.THUMBNAIL_PREVIEW_WIDTH,
+    }
+
+
+async def _render_thumbnail_with_pillow(
+    thumbnail: thumbnails.ScorewatchThumbnail,
+) -> postprocessing.EncodedImages:
+    return await postprocessing.run_in_image_worker(
+        thumbnails.render_scorewatch_normal_as_images,
+        thumbnail,
+        _get_encode_options(),
+    )
+
+
+async def _render_thumbnail_with_chrome(
+    thumbnail: thumbnails.ScorewatchThumbnail,
+) -> postprocessing.EncodedImages | None:
+    # inline the avatar, so the browser doesn't need to fetch anything remotely
+    avatar_url = ""
+    if thumbnail["avatar"] is not None:
+        avatar_url = "data:{};base64,{}".format(
+            thumbnail["avatar"]["content_type"],
+            base64.b64encode(thumbnail["avatar"]["data"]).decode(),
+        )
+
+    mods_html = [
+        f'<div class="mod hard">{html.escape(mod)}</div>' for mod in thumbnail["mods"]
+    ]
+    for modifier in thumbnail["modifiers"]:
+        mods_html.append(f'<div class="mod modifier">{html.escape(modifier)}</div>')
+
+    template_context: dict[str, templates.TemplateValue] = {
+        "assets.base_url": assets.get_assets_base_url(),
+        "user.avatar_url": avatar_url,
+        "user.flag_url": "file://" + assets.get_flag_path(thumbnail["country_code"]),
+        "user.username": thumbnail["username"],
+        "score.grade": thumbnail["grade"],
+        "score.grade_upper": thumbnail["grade"].upper(),
+        "score.rank_golden_html": "rank-golden" if thumbnail["golden"] else "",
+        "score.is_fc_html": "is-fc" if thumbnail["full_combo"] else "",
+        "score.has_misses_html": "has-misses" if thumbnail["miss_count"] > 0 else "",
+        "score.pp": thumbnail["pp"],
+        "score.accuracy": f"{thumbnail['accuracy']:.2f}",
+        "score.miss_count": thumbnail["miss_count"],
+        "score.mods_html": templates.Markup("\n          ".join(mods_html)),
+        "beatmap.name": thumbnail["title"],
+        "beatmap.artist": thumbnail["artist"],
+        "beatmap.version": thumbnail["version"],
+        "beatmap.difficulty": f"{thumbnail['difficulty']:.2f}",
+        "beatmap.difficulty_colour": osu.get_difficulty_colour(thumbnail["difficulty"]),
+        "beatmap.difficulty_text_colour": osu.get_difficulty_text_colour(
+            thumbnail["difficulty"],
+        ),
+    }
+
+    # pass the background in-memory too, as a data url
+    template_context["beatmap.background_url"] = "data:image/jpeg;base64," + (
+        base64.b64encode(thumbnail["background_image_data"]).decode()
+    )
+
+    html_content = state.templates.render("scorewatch_normal", template_context)
+    image_data = await state.webdriver.render_html_as_png_image(html_content)
+
+    # chrome captures losslessly, the thumbnail & its preview are encoded once
+    return await postprocessing.run_in_image_worker(
+        postprocessing.reencode_image_with_preview,
+        image_data,
+        _get_encode_options(),
+    )
+
+
+# recently rendered thumbnails, by their cache key
+_thumbnail_cache: LRUCache[str, postprocessing.EncodedImages] = LRUCache(
+    settings.THUMBNAIL_CACHE_SIZE,
+)
+
+# the cache key of the thumbnail most recently uploaded to each upload key
+_uploaded_thumbnails: LRUCache[str, str] = LRUCache(settings.THUMBNAIL_CACHE_SIZE)
+
+
+def _get_thumbnail_cache_key(inputs: dict[str, typing.Any]) -> str:
+    """Hash everything which affects how a thumbnail looks into a cache key."""
+    if settings.RENDER_ENGINE == "pillow":
+        layout_version = f"pillow:{thumbnails.LAYOUT_VERSION}"
+    else:
+        template = state.templates.get_template("scorewatch_normal")
+        layout_version = f"chrome:{template.digest}"
+
+    cache_key_data = json.dumps(
+        {
+            "layout_version": layout_version,
+            "pipeline_version": postprocessing.PIPELINE_VERSION,
+            "assets_version": assets.ASSETS_VERSION,
+            "fonts_digest": assets.get_fonts_digest(),
+            "encode_options": _get_encode_options(),
+            "inputs": inputs,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(cache_key_data.encode()).hexdigest()
+
+
+def _get_file_extension() -> str:
+    return postprocessing.FILE_EXTENSIONS[_get_encode_options()["image_format"]]
+
+
+def _get_thumbnail_cache_object_key(cache_key: str, preview: bool = False) -> str:
+    suffix = "_preview" if preview else ""
+    return f"/scorewatch/thumbnails/cache/{cache_key}{suffix}.{_get_file_extension()}"
+
+
+async def _get_cached_thumbnail(
+    cache_key: str,
+) -> postprocessing.EncodedImages | None:
+    encoded_images = _thumbnail_cache.get(cache_key)
+    if encoded_images is not None:
+        return encoded_images
+
+    # missing objects are just misses, without a separate existence check
+    image_data = await aws_s3.get_object_data(
+        _get_thumbnail_cache_object_key(cache_key),
+    )
+    if image_data is None:
+        return None
+
+    preview_image_data = await aws_s3.get_object_data(
+        _get_thumbnail_cache_object_key(cache_key, preview=True),
+    )
+    if preview_image_data is None:
+        return None
+
+    encoded_images = {
+        "image_data": image_data,
+        "preview_image_data": preview_image_data,
+    }
+    _thumbnail_cache.set(cache_key, encoded_images)
+    return encoded_images
+
+
+async def _cache_thumbnail(
+    cache_key: str,
+    encoded_images: postprocessing.EncodedImages,
+) -> None:
+    _thumbnail_cache.set(cache_key, encoded_images)
+    saved = await aws_s3.save_object_data(
+        _get_thumbnail_cache_object_key(cache_key, preview=True),
+        encoded_images["preview_image_data"],
+    )
+    if not saved:
+        return
+
+    # written last, as its existence marks the cache entry as complete
+    await aws_s3.save_object_data(
+        _get_thumbnail_cache_object_key(cache_key),
+        encoded_images["image_data"],
+    )
+
+
+async def _upload_thumbnail(
+    upload_key: str,
+    cache_key: str,
+    encoded_images: postprocessing.EncodedImages,
+) -> None:
+    # skip re-uploading the exact thumbnail which is already there
+    if _uploaded_thumbnails.get(upload_key) == cache_key:
+        return
+
+    uploaded = await aws_s3.save_object_data(upload_key, encoded_images["image_data"])
+    if uploaded:
+        _uploaded_thumbnails.set(upload_key, cache_key)
+
+
+class StageFailedError(Exception):
+    """Raised by a stage of generating upload resources which can't continue."""
+
+    def __init__(self, stage: str, message: str) -> None:
+        super().__init__(message)
+        self.stage = stage
+        self.message = message
+
+
+async def _run_stage(
+    stage: str,
+    timings: list[postprocessing.StageTiming],
+    awaitable: Awaitable[T],
+) -> T:
+    started_at = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        timings.append(
+            {
+                "stage": stage,
+                "duration_ms": round((time.perf_counter() - started_at) * 1000, 2),
+            },
+        )
+
+
+def _log_stage_failure(
+    score_data: Score,
+    failure: StageFailedError,
+    timings: list[postprocessing.StageTiming],
+) -> None:
+    logging.warning(
+        "Failed to generate score upload resources",
+        extra={
+            "score_id": score_data["id"],
+            "failed_stage": failure.stage,
+            "stage_timings": timings,
+        },
+    )
+
+
+async def _fetch_beatmap_metadata(score_data: Score) -> osu_beatmaps.BeatmapMetadata:
+    beatmap = await beatmap_files.get_beatmap_metadata(
+        score_data["beatmap"]["beatmap_id"],
+        score_data["beatmap"]["beatmap_md5"],
+    )
+    if not beatmap:
+        if not upstream.is_available("beatmaps"):
+            raise StageFailedError(
+                "beatmap_metadata",
+                "The beatmaps service is unavailable right now, please try again in a few minutes!",
+            )
+
+        raise StageFailedError(
+            "beatmap_metadata",
+            "Couldn't find beatmap associated with this score!",
+        )
+
+    return beatmap
+
+
+async def _fetch_performance(score_data: Score) -> performance.Performance:
+    try:
+        performance_data = await performance.fetch_one(
+            score_data["beatmap"]["beatmap_md5"],
+            score_data["beatmap"]["beatmap_id"],
+            score_data["play_mode"],
+            score_data["mods"],
+            score_data["max_combo"],
+            score_data["accuracy"],
+            score_data["count_miss"],
+        )
+    except upstream.ServiceUnavailableError:
+        raise StageFailedError(
+            "performance",
+            "The performance service is unavailable right now, please try again in a few minutes!",
+        )
+
+    if not performance_data:
+        raise StageFailedError(
+            "performance",
+            "Couldn't generate performance statistics for this score!",
+        )
+
+    return performance_data
+
+
+async def _fetch_background(score_data: Score) -> bytes:
+    background_image_data = await backgrounds.get_processed_background(
+        score_data["beatmap"]["beatmap_id"],
+        postprocessing.NORMAL_TEMPLATE_EFFECTS,
+        score_data["beatmap"]["beatmapset_id"],
+    )
+    if isinstance(background_image_data, str):
+        if not upstream.is_available("beatmaps"):
+            raise StageFailedError(
+                "background",
+                "The beatmaps service is unavailable right now, please try again in a few minutes!",
+            )
+
+        raise StageFailedError("background", background_image_data)
+
+    return background_image_data
+
+
+async def _render_thumbnail(
+    thumbnail: thumbnails.ScorewatchThumbnail,
+) -> postprocessing.EncodedImages:
+    if settings.RENDER_ENGINE == "pillow":
+        return await _render_thumbnail_with_pillow(thumbnail)
+
+    try:
+        encoded_images = await _render_thumbnail_with_chrome(thumbnail)
+    except webdriver.RenderQueueFullError:
+        raise StageFailedError(
+            "render",
+            "The thumbnail renderer is busy right now, please try again in a moment!",
+        )
+    except webdriver.RenderTimeoutError:
+        raise StageFailedError(
+            "render",
+            "Timed out while rendering the thumbnail, please try again!",
+        )
+
+    if encoded_images is None:
+        raise StageFailedError("render", "Couldn't encode the rendered thumbnail!")
+
+    return encoded_images
+
+
+class UpstreamResources(typing.TypedDict):
+    beatmap: osu_beatmaps.BeatmapMetadata
+    performance_data: performance.Performance
+    avatar: osu_avatars.Avatar | None
+
+
+async def _fetch_upstream_resources(
+    score_data: Score,
+    timings: list[postprocessing.StageTiming],
+) -> UpstreamResources:
+    """Fetch everything a score's thumbnail cache key depends on from other
+    services.
+
+    Every fetch only depends on the score, so they're all made concurrently.
+    If any fails with a `StageFailedError`, the others are cancelled.
+    """
+    try:
+        async with asyncio.TaskGroup() as task_group:
+            beatmap_task = task_group.create_task(
+                _run_stage(
+                    "beatmap_metadata",
+                    timings,
+                    _fetch_beatmap_metadata(score_data),
+                ),
+            )
+            performance_task = task_group.create_task(
+                _run_stage("performance", timings, _fetch_performance(score_data)),
+            )
+            avatar_task = task_group.create_task(
+                _run_stage(
+                    "avatar",
+                    timings,
+                    osu_avatars.get_avatar_image_contents(score_data["user"]["id"]),
+                ),
+            )
+    except* StageFailedError as exc_group:
+        # report the first stage which failed, rather than a group of them
+        raise exc_group.exceptions[0]
+
+    return {
+        "beatmap": beatmap_task.result(),
+        "performance_data": performance_task.result(),
+        "avatar": avatar_task.result(),
+    }
+
+
 class ScoreUploadResources(typing.TypedDict):
     title: str
     description: str
+    # the full resolution thumbnail, uploaded alongside the video
     image_data: bytes
+    # a smaller version of the thumbnail, for previews within discord
+    preview_image_data: bytes
+    file_extension: str
 
 
 async def generate_score_upload_resources(
@@ -114,25 +491,25 @@ async def generate_score_upload_resources(
 
     beatmap_id = score_data["beatmap"]["beatmap_id"]
 
-    beatmap_bytes = await osu_beatmaps.get_osu_file_contents(beatmap_id)
+    started_at = time.perf_counter()
+    timings: list[postprocessing.StageTiming] = []
 
-    if not beatmap_bytes:
-        return "Couldn't find beatmap associated with this score!"
-
-    beatmap = osu_beatmaps.parse_beatmap_metadata(beatmap_bytes)
-    background_image_contents = (
-        await osu_beatmaps.get_beatmap_background_image_contents(
-            beatmap_id,
-        )
+    # the background isn't part of the thumbnail's cache key, so it's fetched
+    # alongside everything else, and only awaited if the thumbnail isn't cached
+    background_task = asyncio.create_task(
+        _run_stage("background", timings, _fetch_background(score_data)),
     )
-    if not background_image_contents:
-        return "Couldn't find beatmap associated with this score!"
 
-    with io.BytesIO(background_image_contents) as image_file:
-        background_image = Image.open(image_file)
-        background_image.load()
+    try:
+        upstream_resources = await _fetch_upstream_resources(score_data, timings)
+    except StageFailedError as exc:
+        background_task.cancel()
+        _log_stage_failure(score_data, exc, timings)
+        return exc.message
 
-    background_image = postprocessing.apply_effects_normal_template(background_image)
+    beatmap = upstream_resources["beatmap"]
+    performance_data = upstream_resources["performance_data"]
+    avatar = upstream_resources["avatar"]
 
     if not artist:
         artist = beatmap["artist"]
@@ -146,107 +523,121 @@ async def generate_score_upload_resources(
     if not username:
         username = score_data["user"]["username"]
 
-    performance_data = await performance.fetch_one(
-        score_data["beatmap"]["beatmap_md5"],
-        score_data["beatmap"]["beatmap_id"],
-        score_data["play_mode"],
-        score_data["mods"],
-        score_data["max_combo"],
-        score_data["accuracy"],
-        score_data["count_miss"],
-    )
-
-    if not performance_data:
-        return "Couldn't generate performance statistics for this score!"
-
-    with open(os.path.join("templates", "scorewatch_normal.html")) as f:
-        template = f.read()
-
-    with tempfile.NamedTemporaryFile(suffix=".png") as background_file:
-        background_image.save(background_file.name, format="PNG")
-        template = template.replace(
-            r"<% beatmap.background_url %>",
-            background_file.name,
-        )
-
-        template = template.replace(r"<% user.id %>", str(score_data["user"]["id"]))
-        template = template.replace(
-            r"<% score.grade %>",
-            score_data["rank"].lower().replace("h", ""),
-        )
-        template = template.replace(
-            r"<% score.rank_golden_html %>",
-            "rank-golden" if "H" in score_data["rank"] else "",
-        )
-        template = template.replace(
-            r"<% score.is_fc_html %>",
-            "is-fc" if score_data["full_combo"] else "",
-        )
-        template = template.replace(r"<% user.username %>", username)
-        template = template.replace(
-            r"<% user.country_code %>",
-            score_data["user"]["country"].lower(),
-        )
-        template = template.replace(r"<% score.pp %>", str(int(score_data["pp"])))
-        template = template.replace(
-            r"<% score.accuracy %>",
-            f"{score_data['accuracy']:.2f}",
-        )
+    mod_names = []
+    modifiers = [relax_text]
+    for mod in mods:
 
-        mods_html = []
-        modifiers = [relax_text]
-        for mod in mods:
+        if Mod.Nightcore in mods and mod is Mod.DoubleTime:
+            continue
+        if Mod.Perfect in mods and mod is Mod.SuddenDeath:
+            continue
 
-            if Mod.Nightcore in mods and mod is Mod.DoubleTime:
-                continue
-            if Mod.Perfect in mods and mod is Mod.SuddenDeath:
-                continue
+        if mod == Mod.TouchDevice:
+            modifiers.append("Touchscreen")
+            continue
 
-            if mod == Mod.TouchDevice:
-                modifiers.append("Touchscreen")
-                continue
+        if mod in (Mod.Relax, Mod.Autopilot):
+            continue
 
-            if mod in (Mod.Relax, Mod.Autopilot):
-                continue
+        mod_names.append(mod.short_name)
 
-            mods_html.append(f'<div class="mod hard">{mod.short_name}</div>')
-
-        for modifier in modifiers:
-            mods_html.append(f'<div class="mod modifier">{modifier}</div>')
-
-        template = template.replace(
-            r"<% score.mods_html %>",
-            "\n          ".join(mods_html),
-        )
+    user_id = score_data["user"]["id"]
 
-        template = template.replace(
-            r"<% score.grade_upper %>",
-            score_data["rank"].replace("H", ""),
-        )
-        template = template.replace(r"<% beatmap.name %>", title)
-        template = template.replace(r"<% beatmap.artist %>", artist)
-        template = template.replace(r"<% beatmap.version %>", difficulty_name)
-        template = template.replace(
-            r"<% beatmap.difficulty %>",
-            f"{performance_data['stars']:.2f}",
-        )
+    thumbnail_cache_key = _get_thumbnail_cache_key(
+        {
+            "beatmap_id": beatmap_id,
+            # the background is taken from this exact version of the beatmap
+            "beatmap_md5": score_data["beatmap"]["beatmap_md5"],
+            "avatar": hashlib.sha256(avatar["data"]).hexdigest() if avatar else None,
+            "username": username,
+            "country_code": score_data["user"]["country"],
+            "rank": score_data["rank"],
+            "full_combo": score_data["full_combo"],
+            "pp": int(score_data["pp"]),
+            "accuracy": score_data["accuracy"],
+            "miss_count": score_data["count_miss"],
+            "mods": mod_names,
+            "modifiers": modifiers,
+            "title": title,
+            "artist": artist,
+            "version": difficulty_name,
+            "difficulty": performance_data["stars"],
+        },
+    )
 
-        template = template.replace(
-            r"<% score.has_misses_html %>",
-            "has-misses" if score_data["count_miss"] > 0 else "",
-        )
-        template = template.replace(
-            r"<% score.miss_count %>",
-            str(score_data["count_miss"]),
+    cached_images = await _run_stage(
+        "thumbnail_cache",
+        timings,
+        _get_cached_thumbnail(thumbnail_cache_key),
+    )
+    if cached_images is not None:
+        background_task.cancel()
+        encoded_images = cached_images
+    else:
+        try:
+            background_image_data = await background_task
+        except StageFailedError as exc:
+            _log_stage_failure(score_data, exc, timings)
+            return exc.message
+
+        thumbnail: thumbnails.ScorewatchThumbnail = {
+            "background_image_data": background_image_data,
+            "avatar": avatar,
+            "username": username,
+            "country_code": score_data["user"]["country"],
+            "grade": score_data["rank"].lower().replace("h", ""),
+            "golden": "H" in score_data["rank"],
+            "full_combo": score_data["full_combo"],
+            "pp": int(score_data["pp"]),
+            "accuracy": score_data["accuracy"],
+            "miss_count": score_data["count_miss"],
+            "mods": mod_names,
+            "modifiers": modifiers,
+            "title": title,
+            "artist": artist,
+            "version": difficulty_name,
+            "difficulty": performance_data["stars"],
+        }
+
+        try:
+            encoded_images = await _run_stage(
+                "render",
+                timings,
+                _render_thumbnail(thumbnail),
+            )
+        except StageFailedError as exc:
+            _log_stage_failure(score_data, exc, timings)
+            return exc.message
+
+    file_extension = _get_file_extension()
+    upload_key = f"/scorewatch/thumbnails/{beatmap_id}_{user_id}_score.{file_extension}"
+
+    # caching & uploading the thumbnail are independent, so happen concurrently
+    async with asyncio.TaskGroup() as task_group:
+        if cached_images is None:
+            task_group.create_task(
+                _run_stage(
+                    "thumbnail_cache_store",
+                    timings,
+                    _cache_thumbnail(thumbnail_cache_key, encoded_images),
+                ),
+            )
+
+        task_group.create_task(
+            _run_stage(
+                "upload",
+                timings,
+                _upload_thumbnail(upload_key, thumbnail_cache_key, encoded_images),
+            ),
         )
 
-        thumbnail_image_data = state.webdriver.capture_html_as_jpeg_image(template)
-
-    user_id = score_data["user"]["id"]
-
-    await aws_s3.save_object_data(
-        f"/scorewatch/thumbnails/{beatmap_id}_{user_id}_score.jpg",
-        thumbnail_image_data,
+    logging.info(
+        "Generated score upload resources",
+        extra={
+            "score_id": score_data["id"],
+            "stage_timings": timings,
+            "total_ms": round((time.perf_counter() - started_at) * 1000, 2),
+        },
     )
 
     song_name = f"{artist} - {title} [{difficulty_name}]"
@@ -273,5 +664,7 @@ async def generate_score_upload_resources(
     return {
         "title": title,
         "description": description,
-        "image_data": thumbnail_image_data,
+        "image_data": encoded_images["image_data"],
+        "preview_image_data": encoded_images["preview_image_data"],
+        "file_extension": file_extension,
     }
@@ -0,0 +1,644 @@
+from __future__ import annotations
+
+import functools
+import io
+import logging
+import os
+import re
+import typing
+
+import numpy as np
+from PIL import Image
+from PIL import ImageChops
+from PIL import ImageDraw
+from PIL import ImageFont
+from PIL import ImageOps
+
+from app import osu
+from app import osu_avatars
+from app.adapters import assets
+from app.usecases import postprocessing
+
+# NOTE: the geometry below mirrors the css of templates/scorewatch_normal.html,
+# any layout changes there must also be made here.
+# NOTE: bump whenever the rendered layout changes, so that
+# previously cached thumbnails are no longer used.
+LAYOUT_VERSION = 2
+
+CANVAS_WIDTH = 1920
+CANVAS_HEIGHT = 1080
+
+SUPERSAMPLING = 4
+
+GRADE_COLOURS = {
+    "ss": "#ffbd3b",
+    "s": "#ffbd3b",
+    "a": "#8ef97d",
+    "b": "#61e2ff",
+    "c": "#e756ff",
+    "d": "#ff2f2f",
+}
+GOLDEN_GRADE_COLOUR = "#b1d0d0"
+
+TEXT_COLOUR = "#ffffff"
+DIMMED_TEXT_COLOUR = "#ffffffaa"
+FC_COLOUR = "#ffbd3b"
+MISS_COLOUR = "#ff4422"
+SCORE_BAR_COLOUR = "#00000088"
+AVATAR_PLACEHOLDER_COLOUR = "#00000033"
+HARD_MOD_COLOUR = "#fecb21"
+HARD_MOD_TEXT_COLOUR = "#000000dd"
+MODIFIER_COLOUR = "#ffffff22"
+
+STAR_VIEWBOX = (102, 98)
+STAR_PATH = (
+    "M42.9294 5.35284C46.2307 -1.33637 55.7693 -1.33636 59.0706 5.35285L67.7151 22.8685C69.0261 "
+    "25.5248 71.5601 27.3659 74.4915 27.7918L93.8212 30.6006C101.203 31.6733 104.151 40.745 98.8091 "
+    "45.9518L84.822 59.5858C82.7008 61.6535 81.7329 64.6325 82.2337 67.552L85.5356 86.8035C86.7965 "
+    "94.1557 79.0797 99.7623 72.477 96.2911L55.1881 87.2018C52.5661 85.8234 49.4338 85.8234 46.8119 "
+    "87.2018L29.523 96.2911C22.9203 99.7623 15.2035 94.1557 16.4645 86.8035L19.7663 67.552C20.2671 "
+    "64.6324 19.2991 61.6535 17.178 59.5858L3.19092 45.9518C-2.15073 40.745 0.796868 31.6732 8.17885 "
+    "30.6006L27.5085 27.7918C30.4399 27.3659 32.974 25.5247 34.2849 22.8685L42.9294 5.35284Z"
+)
+
+LOGO_VIEWBOX = (214, 122)
+LOGO_PATHS = (
+    (
+        "M120.58 118.131V3.86893H91.082V11.0909C81.2493 3.69697 70.9853 0 60.2901 0C43.5572 0 29.3257 "
+        "5.93235 17.5954 17.797C5.86513 29.6617 0 44.0197 0 60.871C0 77.8943 5.86513 92.3383 17.5954 "
+        "104.203C29.3257 116.068 43.5572 122 60.2901 122C70.9853 122 81.2493 118.303 91.082 "
+        "110.909V118.131H120.58ZM38.5546 36.1099C44.4197 29.7477 52.0962 26.5666 61.5839 26.5666C70.3816 "
+        "26.5666 77.5405 29.8337 83.0606 36.3679C88.7532 42.7301 91.5995 50.8978 91.5995 60.871C91.5995 "
+        "71.0162 88.7532 79.3559 83.0606 85.8901C77.368 92.2523 69.9503 95.4334 60.8076 95.4334C51.6649 "
+        "95.4334 44.161 92.2523 38.2958 85.8901C32.6032 79.3559 29.7569 71.0162 29.7569 60.871C29.7569 "
+        "50.5539 32.6895 42.3002 38.5546 36.1099ZM161.473 51.8475L210.895 3.87293H172.082L130.422 "
+        "44.6256V82.2831L141.29 71.4501L161.473 51.8475Z",
+        1.0,
+    ),
+    (
+        "M161.078 51.8477L213.605 118.135H177.38L140.895 71.4502L161.078 51.8477Z",
+        0.8,
+    ),
+)
+
+_PATH_TOKEN_PATTERN = re.compile(r"[MLHVCZ]|-?(?:\d+\.?\d*|\.\d+)")
+_BEZIER_SEGMENTS = 16
+
+
+class ScorewatchThumbnail(typing.TypedDict):
+    # the encoded background, already processed by the template's effect chain
+    background_image_data: bytes
+    avatar: osu_avatars.Avatar | None
+    username: str
+    country_code: str
+    grade: str
+    golden: bool
+    full_combo: bool
+    pp: int
+    accuracy: float
+    miss_count: int
+    mods: list[str]
+    modifiers: list[str]
+    title: str
+    artist: str
+    version: str
+    difficulty: float
+
+
+@functools.cache
+def _get_font(size: int, weight: int) -> ImageFont.FreeTypeFont:
+    font = ImageFont.truetype(assets.get_font_path("Nunito.ttf"), size)
+    font.set_variation_by_axes([weight])  # type: ignore[no-untyped-call]
+    return font
+
+
+@functools.cache
+def _get_overlay_image() -> Image.Image:
+    with Image.open(os.path.join("templates", "scorewatch_normal_overlay.png")) as im:
+        return im.convert("RGB")
+
+
+@functools.cache
+def _get_rounded_mask(width: int, height: int, radius: int) -> Image.Image:
+    """Create an antialiased rounded rectangle mask."""
+
+    mask = Image.new("L", (width * SUPERSAMPLING, height * SUPERSAMPLING), 0)
+    ImageDraw.Draw(mask).rounded_rectangle(
+        (0, 0, width * SUPERSAMPLING - 1, height * SUPERSAMPLING - 1),
+        radius=radius * SUPERSAMPLING,
+        fill=255,
+    )
+    return mask.resize((width, height), Image.Resampling.LANCZOS)
+
+
+def _get_circle_mask(size: int) -> Image.Image:
+    return _get_rounded_mask(size, size, size // 2)
+
+
+@functools.cache
+def _get_radial_shade_mask(size: int) -> Image.Image:
+    """Emulate `radial-gradient(#000, #0004)` over a square as an alpha mask."""
+
+    coords = np.arange(size, dtype=np.float32) - (size - 1) / 2
+    distance = np.hypot(coords[np.newaxis, :], coords[:, np.newaxis])
+    ratio = np.clip(distance / distance.max(), 0, 1)
+
+    alpha = 255 - (255 - 0x44) * ratio
+    return Image.fromarray(alpha.astype(np.uint8))
+
+
+def _flatten_svg_path(path: str) -> list[list[tuple[float, float]]]:
+    """Flatten an svg path using absolute M/L/H/V/C/Z commands into polygons."""
+
+    tokens = _PATH_TOKEN_PATTERN.findall(path)
+    polygons: list[list[tuple[float, float]]] = []
+    current: list[tuple[float, float]] = []
+
+    x = y = 0.0
+    command = ""
+    i = 0
+    while i < len(tokens):
+        if tokens[i].isalpha():
+            command = tokens[i]
+            i += 1
+
+            if command == "Z":
+                polygons.append(current)
+                current = []
+                continue
+
+        if command == "M":
+            if current:
+                polygons.append(current)
+
+            x, y = float(tokens[i]), float(tokens[i + 1])
+            current = [(x, y)]
+            command = "L"  # subsequent pairs are implicit line-tos
+            i += 2
+        elif command == "L":
+            x, y = float(tokens[i]), float(tokens[i + 1])
+            current.append((x, y))
+            i += 2
+        elif command == "H":
+            x = float(tokens[i])
+            current.append((x, y))
+            i += 1
+        elif command == "V":
+            y = float(tokens[i])
+            current.append((x, y))
+            i += 1
+        elif command == "C":
+            x1, y1, x2, y2, x3, y3 = map(float, tokens[i : i + 6])
+            for step in range(1, _BEZIER_SEGMENTS + 1):
+                t = step / _BEZIER_SEGMENTS
+                mt = 1 - t
+                current.append(
+                    (
+                        mt**3 * x + 3 * mt**2 * t * x1 + 3 * mt * t**2 * x2 + t**3 * x3,
+                        mt**3 * y + 3 * mt**2 * t * y1 + 3 * mt * t**2 * y2 + t**3 * y3,
+                    ),
+                )
+            x, y = x3, y3
+            i += 6
+        else:
+            raise ValueError(f"Unsupported svg path command {command!r}")
+
+    if current:
+        polygons.append(current)
+
+    return polygons
+
+
+@functools.cache
+def _rasterize_svg_path(
+    path: str,
+    width: int,
+    height: int,
+    scale: float,
+) -> Image.Image:
+    """Rasterize an svg path into an antialiased mask, using the even-odd fill rule."""
+
+    ss_size = (width * SUPERSAMPLING, height * SUPERSAMPLING)
+    factor = scale * SUPERSAMPLING
+
+    filled = np.zeros((ss_size[1], ss_size[0]), dtype=bool)
+    for polygon in _flatten_svg_path(path):
+        layer = Image.new("1", ss_size, 0)
+        ImageDraw.Draw(layer).polygon(
+            [(px * factor, py * factor) for px, py in polygon],
+            fill=1,
+        )
+        filled ^= np.asarray(layer)
+
+    mask = Image.fromarray(filled.astype(np.uint8) * 255)
+    return mask.resize((width, height), Image.Resampling.BOX)
+
+
+def _fill_mask(
+    canvas: Image.Image,
+    colour: str,
+    position: tuple[int, int],
+    mask: Image.Image,
+) -> None:
+    """Fill the area of `mask` on the canvas with a (possibly translucent) colour."""
+
+    layer = Image.new("RGBA", mask.size, colour)
+    alpha = ImageChops.multiply(layer.getchannel("A"), mask)
+    canvas.paste(layer.convert("RGB"), position, alpha)
+
+
+def _baseline(top: float, line_height: float, *fonts: ImageFont.FreeTypeFont) -> float:
+    """Find the baseline of a css line box containing text in the given fonts."""
+
+    offset = 0.0
+    for font in fonts:
+        ascent, descent = font.getmetrics()
+        offset = max(offset, (line_height - (ascent + descent)) / 2 + ascent)
+
+    return top + offset
+
+
+def _normal_line_height(font: ImageFont.FreeTypeFont) -> float:
+    ascent, descent = font.getmetrics()
+    return ascent + descent
+
+
+def _wrap_text(
+    text: str,
+    font: ImageFont.FreeTypeFont,
+    max_width: float,
+    max_lines: int | None = None,
+) -> list[str]:
+    lines: list[str] = []
+    line = ""
+    for word in text.split(" "):
+        candidate = f"{line} {word}" if line else word
+        if not line or font.getlength(candidate) <= max_width:
+            line = candidate
+        else:
+            lines.append(line)
+            line = word
+    lines.append(line)
+
+    if max_lines is not None and len(lines) > max_lines:
+        lines = lines[:max_lines]
+
+        last_line = lines[-1]
+        while last_line and font.getlength(last_line + "…") > max_width:
+            last_line = last_line[:-1]
+        lines[-1] = last_line.rstrip() + "…"
+
+    return lines
+
+
+def _draw_top_area(
+    canvas: Image.Image,
+    draw: ImageDraw.ImageDraw,
+    thumbnail: ScorewatchThumbnail,
+) -> None:
+    centre_y = 160
+    avatar_size = 225
+    avatar_position = (70, centre_y - avatar_size // 2)
+
+    avatar_layer = Image.new(
+        "RGBA",
+        (avatar_size, avatar_size),
+        AVATAR_PLACEHOLDER_COLOUR,
+    )
+    if thumbnail["avatar"] is not None:
+        try:
+            with Image.open(io.BytesIO(thumbnail["avatar"]["data"])) as im:
+                avatar_image = ImageOps.fit(im.convert("RGBA"), avatar_layer.size)
+            avatar_layer.alpha_composite(avatar_image)
+        except OSError:
+            logging.warning("Failed to decode user avatar image", exc_info=True)
+
+    avatar_alpha = ImageChops.multiply(
+        avatar_layer.getchannel("A"),
+        _get_circle_mask(avatar_size),
+    )
+    canvas.paste(avatar_layer.convert("RGB"), avatar_position, avatar_alpha)
+
+    username_font = _get_font(100, 600)
+    username_x = avatar_position[0] + avatar_size + 30 + 10
+    username_height = _normal_line_height(username_font)
+    draw.text(
+        (
+            username_x,
+            _baseline(centre_y - username_height / 2, username_height, username_font),
+        ),
+        thumbnail["username"],
+        font=username_font,
+        fill=TEXT_COLOUR,
+        anchor="ls",
+    )
+
+    flag_height = 88
+    with Image.open(assets.get_flag_path(thumbnail["country_code"], raster=True)) as im:
+        flag_width = round(flag_height * im.width / im.height)
+        flag_image = im.convert("RGBA").resize(
+            (flag_width, flag_height),
+            Image.Resampling.LANCZOS,
+        )
+
+    flag_alpha = ImageChops.multiply(
+        flag_image.getchannel("A"),
+        _get_rounded_mask(flag_width, flag_height, 20),
+    )
+    canvas.paste(
+        flag_image.convert("RGB"),
+        (
+            round(username_x + username_font.getlength(thumbnail["username"]) + 20),
+            centre_y - flag_height // 2,
+        ),
+        flag_alpha,
+    )
+
+
+def _draw_score_bar(
+    canvas: Image.Image,
+    draw: ImageDraw.ImageDraw,
+    thumbnail: ScorewatchThumbnail,
+) -> None:
+    draw.rectangle((0, 320, CANVAS_WIDTH, 646), fill=SCORE_BAR_COLOUR)
+
+    # pp (140px) + mods margin (20px) + mods (54px), centred within the bar
+    top = 320 + (326 - 214) // 2
+    x: float = 70
+
+    pp_font = _get_font(140, 800)
+    pp_unit_font = _get_font(113, 500)
+    pp_text = str(thumbnail["pp"])
+    pp_baseline = _baseline(top, 140, pp_font, pp_unit_font)
+    draw.text((x, pp_baseline), pp_text, font=pp_font, fill=TEXT_COLOUR, anchor="ls")
+    x += pp_font.getlength(pp_text)
+    draw.text(
+        (x, pp_baseline),
+        "pp",
+        font=pp_unit_font,
+        fill=DIMMED_TEXT_COLOUR,
+        anchor="ls",
+    )
+    x += pp_unit_font.getlength("pp") + 40
+
+    accuracy_font = _get_font(100, 300)
+    accuracy_colour = FC_COLOUR if thumbnail["full_combo"] else DIMMED_TEXT_COLOUR
+    accuracy_text = f"{thumbnail['accuracy']:.2f}% "
+    # the accuracy is bottom aligned with the pp, with a -12px bottom margin
+    accuracy_ascent, _ = accuracy_font.getmetrics()
+    accuracy_baseline = (
+        top + 140 + 12 - _normal_line_height(accuracy_font) + accuracy_ascent
+    )
+    draw.text(
+        (x, accuracy_baseline),
+        accuracy_text,
+        font=accuracy_font,
+        fill=accuracy_colour,
+        anchor="ls",
+    )
+    x += accuracy_font.getlength(accuracy_text)
+
+    if thumbnail["full_combo"]:
+        draw.text(
+            (x, accuracy_baseline),
+            "FC",
+            font=_get_font(100, 900),
+            fill=accuracy_colour,
+            anchor="ls",
+        )
+    elif thumbnail["miss_count"] > 0:
+        draw.text(
+            (x, accuracy_baseline),
+            f"{thumbnail['miss_count']}x",
+            font=_get_font(90, 900),
+            fill=MISS_COLOUR,
+            anchor="ls",
+        )
+
+    mod_font = _get_font(45, 900)
+    mod_top = top + 140 + 20
+    mod_height = 54
+    mod_x = 70
+    mod_baseline = _baseline(mod_top, mod_height, mod_font)
+
+    badges = [(mod, HARD_MOD_COLOUR, HARD_MOD_TEXT_COLOUR) for mod in thumbnail["mods"]]
+    badges += [
+        (modifier, MODIFIER_COLOUR, TEXT_COLOUR) for modifier in thumbnail["modifiers"]
+    ]
+    for text, colour, text_colour in badges:
+        mod_width = round(mod_font.getlength(text)) + 50
+        _fill_mask(
+            canvas,
+            colour,
+            (mod_x, mod_top),
+            _get_rounded_mask(mod_width, mod_height, mod_height // 2),
+        )
+        draw.text(
+            (mod_x + 25, mod_baseline),
+            text,
+            font=mod_font,
+            fill=text_colour,
+            anchor="ls",
+        )
+        mod_x += mod_width + 6
+
+
+def _draw_rank_circle(
+    canvas: Image.Image,
+    draw: ImageDraw.ImageDraw,
+    thumbnail: ScorewatchThumbnail,
+    background_image: Image.Image,
+) -> None:
+    outer_size = 575
+    inner_size = 526
+    outer_position = (CANVAS_WIDTH - 100 - outer_size, 320 + (326 - outer_size) // 2)
+    inner_position = (
+        outer_position[0] + (outer_size - inner_size) // 2,
+        outer_position[1] + (outer_size - inner_size) // 2,
+    )
+
+    grade_colour = GRADE_COLOURS.get(thumbnail["grade"])
+    if thumbnail["golden"]:
+        grade_colour = GOLDEN_GRADE_COLOUR
+
+    if grade_colour is not None:
+        _fill_mask(canvas, grade_colour, outer_position, _get_circle_mask(outer_size))
+
+    inner_image = ImageOps.fit(
+        background_image,
+        (inner_size, inner_size),
+    )
+    inner_image = Image.composite(
+        Image.new("RGB", inner_image.size, "#000000"),
+        inner_image,
+        _get_radial_shade_mask(inner_size),
+    )
+    canvas.paste(inner_image, inner_position, _get_circle_mask(inner_size))
+
+    grade_font = _get_font(232, 900)
+    grade_height = _normal_line_height(grade_font)
+    centre = (outer_position[0] + outer_size / 2, outer_position[1] + outer_size / 2)
+    draw.text(
+        (centre[0], _baseline(centre[1] - grade_height / 2, grade_height, grade_font)),
+        thumbnail["grade"].upper(),
+        font=grade_font,
+        fill=grade_colour or TEXT_COLOUR,
+        anchor="ms",
+    )
+
+
+def _draw_bottom_area(
+    canvas: Image.Image,
+    draw: ImageDraw.ImageDraw,
+    thumbnail: ScorewatchThumbnail,
+) -> None:
+    left = 70
+    top: float = 646 + 70
+    bottom = CANVAS_HEIGHT - 70
+
+    title_font = _get_font(75, 600)
+    title_line_height = 75 * 1.1
+    for line in _wrap_text(thumbnail["title"], title_font, 1300):
+        draw.text(
+            (left, _baseline(top, title_line_height, title_font)),
+            line,
+            font=title_font,
+            fill=TEXT_COLOUR,
+            anchor="ls",
+        )
+        top += title_line_height
+
+    by_font = _get_font(60, 400)
+    artist_font = _get_font(60, 700)
+    artist_baseline = _baseline(top, 60 * 1.2, by_font, artist_font)
+    draw.text(
+        (left, artist_baseline),
+        "by ",
+        font=by_font,
+        fill="#ffffffcc",
+        anchor="ls",
+    )
+    draw.text(
+        (left + by_font.getlength("by "), artist_baseline),
+        thumbnail["artist"],
+        font=artist_font,
+        fill="#ffffffcc",
+        anchor="ls",
+    )
+
+    # difficulty badge: 15px/20px/15px/30px padding around a 60px star & text
+    star_height = 60
+    star_width = round(star_height * STAR_VIEWBOX[0] / STAR_VIEWBOX[1])
+    difficulty_font = _get_font(60, 900)
+    difficulty_text = f"{thumbnail['difficulty']:.2f}"
+    badge_width = (
+        20 + star_width + round(difficulty_font.getlength(difficulty_text)) + 30
+    )
+    badge_height = 15 + star_height + 8 + 15
+
+    version_font = _get_font(90, 900)
+    version_width = min(1500, CANVAS_WIDTH - 2 * 70 - 20 - 20 - badge_width)
+    version_lines = _wrap_text(
+        f"[{thumbnail['version']}]",
+        version_font,
+        version_width,
+        max_lines=2,
+    )
+
+    row_height = max(badge_height, 90 * len(version_lines))
+    row_top = bottom - row_height
+
+    version_top = row_top + (row_height - 90 * len(version_lines)) / 2
+    for line in version_lines:
+        draw.text(
+            (left, _baseline(version_top, 90, version_font)),
+            line,
+            font=version_font,
+            fill=TEXT_COLOUR,
+            anchor="ls",
+        )
+        version_top += 90
+
+    text_colour = osu.get_difficulty_text_colour(thumbnail["difficulty"])
+
+    badge_position = (
+        left + version_width + 20,
+        round(row_top + (row_height - badge_height) / 2),
+    )
+    _fill_mask(
+        canvas,
+        osu.get_difficulty_colour(thumbnail["difficulty"]),
+        badge_position,
+        _get_rounded_mask(badge_width, badge_height, badge_height // 2),
+    )
+    _fill_mask(
+        canvas,
+        text_colour,
+        (badge_position[0] + 20, badge_position[1] + 15),
+        _rasterize_svg_path(
+            STAR_PATH,
+            star_width,
+            star_height,
+            star_height / STAR_VIEWBOX[1],
+        ),
+    )
+    draw.text(
+        (
+            badge_position[0] + 20 + star_width,
+            _baseline(badge_position[1] + 15 + 4, 60, difficulty_font),
+        ),
+        difficulty_text,
+        font=difficulty_font,
+        fill=text_colour,
+        anchor="ls",
+    )
+
+
+def _draw_logo(canvas: Image.Image) -> None:
+    """Draw the akatsuki logo in the corner, using the `overlay` blend mode."""
+
+    width, height = LOGO_VIEWBOX
+    box = (CANVAS_WIDTH - 40 - width, 40, CANVAS_WIDTH - 40, 40 + height)
+
+    region = np.asarray(canvas.crop(box), dtype=np.float32) / 255
+    for path, opacity in LOGO_PATHS:
+        coverage = np.asarray(
+            _rasterize_svg_path(path, width, height, 1.0),
+            dtype=np.float32,
+        )[..., np.newaxis] * (opacity / 255)
+
+        # overlaying white onto a backdrop doubles it, saturating at white
+        overlaid = np.minimum(region * 2, 1)
+        region = region * (1 - coverage) + overlaid * coverage
+
+    canvas.paste(Image.fromarray((region * 255).round().astype(np.uint8)), box[:2])
+
+
+def render_scorewatch_normal(thumbnail: ScorewatchThumbnail) -> Image.Image:
+    """Render the scorewatch_normal thumbnail layout without a browser."""
+
+    with Image.open(io.BytesIO(thumbnail["background_image_data"])) as im:
+        background_image = im.convert("RGB")
+
+    canvas = background_image
+    if canvas.size != (CANVAS_WIDTH, CANVAS_HEIGHT):
+        canvas = ImageOps.fit(canvas, (CANVAS_WIDTH, CANVAS_HEIGHT))
+
+    canvas = Image.blend(canvas, _get_overlay_image(), 0.8)
+    draw = ImageDraw.Draw(canvas, "RGBA")
+
+    _draw_top_area(canvas, draw, thumbnail)
+    _draw_score_bar(canvas, draw, thumbnail)
+    _draw_rank_circle(canvas, draw, thumbnail, background_image)
+    _draw_bottom_area(canvas, draw, thumbnail)
+    _draw_logo(canvas)
+
+    return canvas
+
+
+def render_scorewatch_normal_as_images(
+    thumbnail: ScorewatchThumbnail,
+    encode_options: postprocessing.EncodeOptions,
+) -> postprocessing.EncodedImages:
+    image = render_scorewatch_normal(thumbnail)
+    return postprocessing.encode_image_with_preview(image, encode_options)
@@ -0,0 +1 @@
+DROP TABLE performance_results;
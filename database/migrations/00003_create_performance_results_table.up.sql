@@ -0,0 +1,12 @@
+CREATE TABLE performance_results (
+    beatmap_md5 TEXT NOT NULL,
+    mode INTEGER NOT NULL,
+    mods INTEGER NOT NULL,
+    max_combo INTEGER NOT NULL,
+    accuracy DOUBLE PRECISION NOT NULL,
+    miss_count INTEGER NOT NULL,
+    pp DOUBLE PRECISION NOT NULL,
+    stars DOUBLE PRECISION NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (beatmap_md5, mode, mods, max_combo, accuracy, miss_count)
+);
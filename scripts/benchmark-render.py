@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""Benchmark scorewatch thumbnail generation, end to end.
+
+Runs `generate_score_upload_resources` from a score dict through to encoded
+bytes for each render engine. The beatmaps-service, performance service,
+avatar server & S3 are replaced with local stand-ins, so results only
+reflect the work done by the bot itself (plus any simulated latency).
+
+Results are written as json, so they can be compared between commits.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+from PIL import Image
+from PIL import ImageDraw
+
+from app import osu_avatars
+from app import osu_beatmaps
+from app import state
+from app.adapters import aws_s3
+from app.adapters import webdriver
+from app.common import cache
+from app.common import settings
+from app.common import templates
+from app.repositories import performance
+from app.repositories.scores import Score
+from app.usecases import backgrounds
+from app.usecases import beatmap_files
+from app.usecases import postprocessing
+from app.usecases import scorewatch
+
+ENGINES = ("chrome", "pillow")
+
+# how often process memory & chrome processes are sampled during a run
+SAMPLE_INTERVAL = 0.05
+
+OSU_FILE_CONTENTS = b"""\
+osu file format v14
+
+[Metadata]
+Title:Benchmark Song
+TitleUnicode:Benchmark Song
+Artist:Benchmark Artist
+ArtistUnicode:Benchmark Artist
+Creator:Benchmark Mapper
+Version:Benchmark Difficulty
+"""
+
+
+class LatencyStats(typing.TypedDict):
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    mean_ms: float
+    min_ms: float
+    max_ms: float
+
+
+class EngineResults(typing.TypedDict):
+    engine: str
+    renders: int
+    failures: int
+    concurrency: int
+    wall_time_s: float
+    throughput_per_s: float
+    latency: LatencyStats
+    peak_rss_bytes: int
+    peak_chrome_rss_bytes: int
+    peak_chrome_processes: int
+    peak_image_worker_rss_bytes: int
+
+
+def _create_background_image() -> bytes:
+    image = Image.linear_gradient("L").resize((1920, 1080)).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for x in range(0, 1920, 120):
+        draw.line((x, 0, 1920 - x, 1080), fill=(255, 102, 170), width=8)
+
+    with io.BytesIO() as buffer:
+        image.save(buffer, format="JPEG", quality=90)
+        return buffer.getvalue()
+
+
+def _create_avatar_image() -> bytes:
+    image = Image.radial_gradient("L").convert("RGB")
+    with io.BytesIO() as buffer:
+        image.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+
+def install_stand_ins(upstream_latency: float) -> None:
+    """Replace every upstream the thumbnail pipeline talks to with a local one."""
+    background_image_contents = _create_background_image()
+    avatar_image_contents = _create_avatar_image()
+    s3_objects: dict[str, bytes] = {}
+
+    async def get_osu_file_contents(beatmap_id: int) -> bytes | None:
+        await asyncio.sleep(upstream_latency)
+        return OSU_FILE_CONTENTS
+
+    async def get_beatmap_background_image_contents(beatmap_id: int) -> bytes | None:
+        await asyncio.sleep(upstream_latency)
+        return background_image_contents
+
+    async def get_avatar_image_contents(user_id: int) -> osu_avatars.Avatar | None:
+        await asyncio.sleep(upstream_latency)
+        return {"content_type": "image/png", "data": avatar_image_contents}
+
+    async def fetch_many(
+        requests: list[performance.PerformanceRequest],
+    ) -> list[performance.Performance | None]:
+        await asyncio.sleep(upstream_latency)
+        return [{"pp": 727.0, "stars": 7.27} for _ in requests]
+
+    async def get_object_data(key: str) -> bytes | None:
+        await asyncio.sleep(upstream_latency)
+        return s3_objects.get(key)
+
+    async def save_object_data(key: str, data: bytes) -> bool:
+        await asyncio.sleep(upstream_latency)
+        s3_objects[key] = data
+        return True
+
+    osu_beatmaps.get_osu_file_contents = get_osu_file_contents
+    osu_beatmaps.get_beatmap_background_image_contents = (
+        get_beatmap_background_image_contents
+    )
+    osu_avatars.get_avatar_image_contents = get_avatar_image_contents
+    # concurrent renders' calculations are still batched together
+    performance._batcher.func = fetch_many
+    aws_s3.get_object_data = get_object_data
+    aws_s3.save_object_data = save_object_data
+
+
+def make_score(n: int) -> Score:
+    # every render gets a unique score & beatmap, so none are served from a cache
+    return {
+        "user": {"id": 1000 + n, "username": "benchmark", "country": "JP"},
+        "beatmap": {
+            "beatmap_md5": f"{n:032x}",
+            "beatmap_id": n,
+            "beatmapset_id": n,
+            "song_name": "Benchmark Artist - Benchmark Song [Benchmark Difficulty]",
+            "ar": 9.3,
+            "od": 8.8,
+            "max_combo": 1234,
+        },
+        "id": str(scorewatch.RELAX_OFFSET + n),
+        "score": 72727272,
+        "max_combo": 1234,
+        "full_combo": True,
+        "mods": 8 | 16 | 64,  # HDHRDT
+        "count_300": 1000,
+        "count_100": 10,
+        "count_50": 0,
+        "count_miss": 0,
+        "count_katu": 0,
+        "count_geki": 0,
+        "play_mode": 0,
+        "accuracy": 99.0 - n / 1000,
+        "pp": 727.0,
+        "rank": "SH",
+    }
+
+
+def _read_rss_bytes(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _get_descendant_processes() -> dict[int, str]:
+    """Find the pid & name of every process descending from this one."""
+    children: dict[int, list[int]] = {}
+    names: dict[int, str] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+
+        # the process name is parenthesized, and may itself contain spaces
+        name_end = stat.rindex(")")
+        pid = int(entry)
+        names[pid] = stat[stat.index("(") + 1 : name_end]
+        ppid = int(stat[name_end + 2 :].split()[1])
+        children.setdefault(ppid, []).append(pid)
+
+    descendants = {}
+    pending = list(children.get(os.getpid(), []))
+    while pending:
+        pid = pending.pop()
+        descendants[pid] = names[pid]
+        pending.extend(children.get(pid, []))
+
+    return descendants
+
+
+class ResourceSampler:
+    def __init__(self) -> None:
+        self.peak_rss_bytes = 0
+        self.peak_chrome_rss_bytes = 0
+        self.peak_chrome_processes = 0
+        self.peak_image_worker_rss_bytes = 0
+
+    def sample(self) -> None:
+        self.peak_rss_bytes = max(self.peak_rss_bytes, _read_rss_bytes(os.getpid()))
+
+        descendants = _get_descendant_processes()
+        chrome_pids = [
+            pid
+            for pid, name in descendants.items()
+            if name.startswith("chrome") and name != "chromedriver"
+        ]
+        image_worker_pids = [
+            pid for pid, name in descendants.items() if name.startswith("python")
+        ]
+
+        self.peak_image_worker_rss_bytes = max(
+            self.peak_image_worker_rss_bytes,
+            sum(_read_rss_bytes(pid) for pid in image_worker_pids),
+        )
+        self.peak_chrome_processes = max(self.peak_chrome_processes, len(chrome_pids))
+        self.peak_chrome_rss_bytes = max(
+            self.peak_chrome_rss_bytes,
+            sum(_read_rss_bytes(pid) for pid in chrome_pids),
+        )
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.to_thread(self.sample)
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+
+def summarize_latencies(latencies: list[float]) -> LatencyStats:
+    if len(latencies) < 2:
+        latencies = latencies * 2
+
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p95_ms": round(percentiles[94] * 1000, 2),
+        "p99_ms": round(percentiles[98] * 1000, 2),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 2),
+        "min_ms": round(min(latencies) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2),
+    }
+
+
+async def benchmark_engine(
+    engine: str,
+    renders: int,
+    concurrency: int,
+    warmup_renders: int,
+) -> EngineResults:
+    settings.RENDER_ENGINE = engine
+    if engine == "chrome":
+        state.webdriver = webdriver.WebDriver(
+            pool_size=settings.WEBDRIVER_POOL_SIZE,
+            max_renders_per_session=settings.WEBDRIVER_MAX_RENDERS_PER_SESSION,
+            max_queue_depth=settings.WEBDRIVER_MAX_QUEUE_DEPTH,
+            render_timeout=settings.WEBDRIVER_RENDER_TIMEOUT,
+        )
+        await asyncio.to_thread(state.webdriver.warm_up)
+
+    # unique scores per engine, so that engines don't share cached thumbnails
+    score_offset = ENGINES.index(engine) * 1_000_000
+
+    try:
+        for n in range(warmup_renders):
+            await scorewatch.generate_score_upload_resources(
+                make_score(score_offset + renders + n),
+            )
+
+        sampler = ResourceSampler()
+        sampler_task = asyncio.create_task(sampler.run())
+
+        latencies: list[float] = []
+        failures = 0
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def render(n: int) -> None:
+            nonlocal failures
+            async with semaphore:
+                started_at = time.perf_counter()
+                result = await scorewatch.generate_score_upload_resources(
+                    make_score(score_offset + n),
+                )
+                if isinstance(result, str):
+                    print(f"[{engine}] render failed: {result}", file=sys.stderr)
+                    failures += 1
+                else:
+                    latencies.append(time.perf_counter() - started_at)
+
+        started_at = time.perf_counter()
+        await asyncio.gather(*(render(n) for n in range(renders)))
+        wall_time = time.perf_counter() - started_at
+
+        sampler_task.cancel()
+        sampler.sample()
+    finally:
+        if engine == "chrome":
+            await asyncio.to_thread(state.webdriver.close)
+
+    return {
+        "engine": engine,
+        "renders": renders,
+        "failures": failures,
+        "concurrency": concurrency,
+        "wall_time_s": round(wall_time, 3),
+        "throughput_per_s": round(len(latencies) / wall_time, 3),
+        "latency": summarize_latencies(latencies or [0.0]),
+        "peak_rss_bytes": sampler.peak_rss_bytes,
+        "peak_chrome_rss_bytes": sampler.peak_chrome_rss_bytes,
+        "peak_chrome_processes": sampler.peak_chrome_processes,
+        "peak_image_worker_rss_bytes": sampler.peak_image_worker_rss_bytes,
+    }
+
+
+def get_git_commit() -> str | None:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        action="append",
+        help="render engine to benchmark, may be repeated (default: all)",
+    )
+    parser.add_argument("--renders", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--warmup-renders", type=int, default=3)
+    parser.add_argument(
+        "--upstream-latency-ms",
+        type=float,
+        default=0,
+        help="simulated latency of every upstream request",
+    )
+    parser.add_argument("--output", help="write results here instead of stdout")
+    args = parser.parse_args()
+
+    install_stand_ins(args.upstream_latency_ms / 1000)
+    settings.BACKGROUND_CACHE_DIRECTORY = tempfile.mkdtemp(prefix="benchmark-")
+    settings.OSU_FILE_CACHE_DIRECTORY = tempfile.mkdtemp(prefix="benchmark-")
+    state.templates = templates.TemplateEngine("templates")
+    state.image_process_pool = postprocessing.create_image_process_pool(
+        settings.IMAGE_WORKER_COUNT,
+    )
+    await asyncio.to_thread(
+        postprocessing.warm_up_image_process_pool,
+        state.image_process_pool,
+        settings.IMAGE_WORKER_COUNT,
+    )
+
+    all_engine_results = [
+        await benchmark_engine(
+            engine,
+            args.renders,
+            args.concurrency,
+            args.warmup_renders,
+        )
+        for engine in args.engine or ENGINES
+    ]
+
+    for engine_results in all_engine_results:
+        latency = engine_results["latency"]
+        print(
+            f"{engine_results['engine']}: "
+            f"p50={latency['p50_ms']}ms p95={latency['p95_ms']}ms "
+            f"p99={latency['p99_ms']}ms "
+            f"throughput={engine_results['throughput_per_s']}/s "
+            f"failures={engine_results['failures']}",
+            file=sys.stderr,
+        )
+
+    state.image_process_pool.shutdown()
+
+    results = {
+        "commit": get_git_commit(),
+        "timestamp": time.time(),
+        "upstream_latency_ms": args.upstream_latency_ms,
+        "engines": all_engine_results,
+        "background_cache": backgrounds.get_cache_stats(),
+        "osu_file_cache": beatmap_files.get_cache_stats(),
+        "performance_cache": performance.get_cache_stats(),
+        "single_flights": cache.get_single_flight_stats(),
+    }
+    shutil.rmtree(settings.BACKGROUND_CACHE_DIRECTORY)
+    shutil.rmtree(settings.OSU_FILE_CACHE_DIRECTORY)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(main()))
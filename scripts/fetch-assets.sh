@@ -0,0 +1,97 @@
+#!/usr/bin/env bash
+set -euo pipefail
+
+# NOTE: keep in sync with `ASSETS_VERSION` in app/adapters/assets.py,
+# and bump it whenever any of the pinned assets below change.
+ASSETS_VERSION=5
+
+FLAG_ICONS_VERSION=7.2.3
+
+# the google/fonts commit the fonts are fetched from, and their sha256 digests;
+# run `$0 --pin` to resolve the latest commit & print new values for these.
+# while they're unresolved, the fonts are fetched from the current commit of
+# google/fonts' main branch without being verified.
+GOOGLE_FONTS_REVISION=unresolved
+NUNITO_SHA256=unresolved
+NUNITO_ITALIC_SHA256=unresolved
+
+GOOGLE_FONTS_REPO=https://github.com/google/fonts
+NUNITO_PATH="ofl/nunito/Nunito%5Bwght%5D.ttf"
+NUNITO_ITALIC_PATH="ofl/nunito/Nunito-Italic%5Bwght%5D.ttf"
+
+# download a file & check it has the expected sha256 digest, if it's pinned
+fetch_verified() {
+  local url="$1" output="$2" sha256="$3"
+  curl -fsSL -o "$output" "$url"
+  if [[ "$sha256" != "unresolved" ]]; then
+    echo "${sha256}  ${output}" | sha256sum --check --quiet
+  fi
+}
+
+resolve_google_fonts_revision() {
+  git ls-remote "${GOOGLE_FONTS_REPO}.git" refs/heads/main | cut -f1
+}
+
+if [[ "${1:-}" == "--pin" ]]; then
+  revision=$(resolve_google_fonts_revision)
+  pin_dir=$(mktemp -d)
+  trap 'rm -rf "$pin_dir"' EXIT
+
+  curl -fsSL -o "$pin_dir/Nunito.ttf" "${GOOGLE_FONTS_REPO}/raw/${revision}/${NUNITO_PATH}"
+  curl -fsSL -o "$pin_dir/Nunito-Italic.ttf" "${GOOGLE_FONTS_REPO}/raw/${revision}/${NUNITO_ITALIC_PATH}"
+
+  echo "GOOGLE_FONTS_REVISION=${revision}"
+  echo "NUNITO_SHA256=$(sha256sum "$pin_dir/Nunito.ttf" | cut -d' ' -f1)"
+  echo "NUNITO_ITALIC_SHA256=$(sha256sum "$pin_dir/Nunito-Italic.ttf" | cut -d' ' -f1)"
+  exit 0
+fi
+
+if [[ $# -ne 1 ]]; then
+    echo "Usage: $0 <assets root>"
+    echo "       $0 --pin"
+    exit 1
+fi
+
+if [[ "$GOOGLE_FONTS_REVISION" == "unresolved" ]]; then
+    GOOGLE_FONTS_REVISION=$(resolve_google_fonts_revision)
+    echo "WARNING: the fonts aren't pinned, using google/fonts@${GOOGLE_FONTS_REVISION} unverified;"
+    echo "         run \`$0 --pin\` and fill in the values it prints"
+fi
+
+ASSETS_DIR="$1/v${ASSETS_VERSION}"
+WORK_DIR=$(mktemp -d)
+trap 'rm -rf "$WORK_DIR"' EXIT
+
+mkdir -p "$ASSETS_DIR/fonts" "$ASSETS_DIR/flags"
+
+echo "Fetching Nunito fonts from google/fonts@${GOOGLE_FONTS_REVISION}.."
+fetch_verified \
+  "${GOOGLE_FONTS_REPO}/raw/${GOOGLE_FONTS_REVISION}/${NUNITO_PATH}" \
+  "$ASSETS_DIR/fonts/Nunito.ttf" \
+  "$NUNITO_SHA256"
+fetch_verified \
+  "${GOOGLE_FONTS_REPO}/raw/${GOOGLE_FONTS_REVISION}/${NUNITO_ITALIC_PATH}" \
+  "$ASSETS_DIR/fonts/Nunito-Italic.ttf" \
+  "$NUNITO_ITALIC_SHA256"
+# the thumbnail cache keys include these, so thumbnails rendered with
+# different fonts are never reused
+(cd "$ASSETS_DIR/fonts" && sha256sum Nunito.ttf Nunito-Italic.ttf > SHA256SUMS)
+
+echo "Fetching flag-icons ${FLAG_ICONS_VERSION}.."
+curl -fsSL -o "$WORK_DIR/flag-icons.tgz" \
+  "https://registry.npmjs.org/flag-icons/-/flag-icons-${FLAG_ICONS_VERSION}.tgz"
+tar -xzf "$WORK_DIR/flag-icons.tgz" -C "$WORK_DIR"
+cp "$WORK_DIR"/package/flags/4x3/*.svg "$ASSETS_DIR/flags/"
+
+# the pillow render engine can't draw svgs, so also keep raster copies
+# at twice the size they are displayed at in the thumbnail.
+echo "Rasterizing flags.."
+mkdir -p "$ASSETS_DIR/flags/png"
+for flag in "$ASSETS_DIR"/flags/*.svg; do
+  rsvg-convert --height 176 --output "$ASSETS_DIR/flags/png/$(basename "$flag" .svg).png" "$flag"
+done
+
+# an empty document which the renderer writes thumbnails into
+echo "<!DOCTYPE html><html></html>" > "$ASSETS_DIR/blank.html"
+
+echo "Assets v${ASSETS_VERSION} are available in ${ASSETS_DIR}"
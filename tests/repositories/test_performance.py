@@ -0,0 +1,59 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from app.adapters import upstream
+from app.repositories import performance
+
+
+def _make_request(beatmap_md5: str) -> performance.PerformanceRequest:
+    return {
+        "beatmap_md5": beatmap_md5,
+        "beatmap_id": 1,
+        "mode": 0,
+        "mods": 0,
+        "max_combo": 727,
+        "accuracy": 100.0,
+        "miss_count": 0,
+    }
+
+
+def test_fetch_many_only_fails_the_rejected_scores(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    batch_sizes: list[int] = []
+
+    def handle_request(request: httpx.Request) -> httpx.Response:
+        calculations = json.loads(request.content)
+        batch_sizes.append(len(calculations))
+
+        # the service rejects the whole request over one score's inputs
+        if any(calc["beatmap_md5"] == "unknown" for calc in calculations):
+            return httpx.Response(422, json={"error": "Unknown beatmap"})
+
+        return httpx.Response(
+            200,
+            json=[{"pp": 727.0, "stars": 7.27}] * len(calculations),
+        )
+
+    client = httpx.AsyncClient(
+        base_url="http://performance-service",
+        transport=httpx.MockTransport(handle_request),
+    )
+    monkeypatch.setattr(upstream, "get_client", lambda service: client)
+
+    results = asyncio.run(
+        performance.fetch_many(
+            [_make_request("known"), _make_request("unknown"), _make_request("known")],
+        ),
+    )
+
+    assert results == [
+        {"pp": 727.0, "stars": 7.27},
+        None,
+        {"pp": 727.0, "stars": 7.27},
+    ]
+    # the rejected batch is retried one score at a time
+    assert batch_sizes == [3, 1, 1, 1]
@@ -0,0 +1,64 @@
+import io
+import zipfile
+
+from app.usecases import backgrounds
+
+
+def _make_osu_file(beatmap_id: int, background_filename: str) -> str:
+    # a long [Editor] section pushes [Metadata] well past the first chunk
+    bookmarks = ",".join(str(time) for time in range(0, 5_000_000, 1000))
+    return (
+        "osu file format v14\n\n"
+        "[General]\nAudioFilename: audio.mp3\n\n"
+        f"[Editor]\nBookmarks: {bookmarks}\n\n"
+        f"[Metadata]\nTitle:Song\nVersion:Diff {beatmap_id}\n"
+        f"BeatmapID:{beatmap_id}\nBeatmapSetID:1\n\n"
+        "[Difficulty]\nHPDrainRate:5\n\n"
+        f'[Events]\n//Background and Video events\n0,0,"{background_filename}",0,0\n\n'
+        "[HitObjects]\n256,192,1000,1,0,0:0:0:0:\n"
+    )
+
+
+def _make_osz_file() -> io.BytesIO:
+    osz_file = io.BytesIO()
+    with zipfile.ZipFile(osz_file, "w") as osz:
+        osz.writestr(
+            "Artist - Song (Mapper) [Diff 100].osu",
+            _make_osu_file(100, "bg1.jpg"),
+        )
+        osz.writestr(
+            "Artist - Song (Mapper) [Diff 200].osu",
+            _make_osu_file(200, "BG2.jpg"),
+        )
+        osz.writestr("bg1.jpg", b"first background")
+        osz.writestr("bg2.jpg", b"second background")
+
+    osz_file.seek(0)
+    return osz_file
+
+
+def test_extract_background_from_osz_finds_each_beatmaps_background() -> None:
+    assert backgrounds._extract_background_from_osz(_make_osz_file(), 100) == (
+        b"first background"
+    )
+    assert backgrounds._extract_background_from_osz(_make_osz_file(), 200) == (
+        b"second background"
+    )
+
+
+def test_extract_background_from_osz_skips_unreadable_backgrounds() -> None:
+    osz_file = io.BytesIO()
+    with zipfile.ZipFile(osz_file, "w") as osz:
+        osz.writestr(
+            "Artist - Song (Mapper) [Diff 100].osu",
+            _make_osu_file(100, "bg1.jpg"),
+        )
+        osz.writestr("bg1.jpg", b"encrypted background")
+
+    # mark the background (the last member) as encrypted in the central
+    # directory, which zipfile can't read without a password
+    osz_data = bytearray(osz_file.getvalue())
+    background_header = osz_data.rindex(b"PK\x01\x02")
+    osz_data[background_header + 8] |= 0x1
+
+    assert backgrounds._extract_background_from_osz(io.BytesIO(osz_data), 100) is None
@@ -0,0 +1,53 @@
+from PIL import Image
+from PIL import ImageChops
+
+from app.usecases import postprocessing
+
+
+def _make_image() -> Image.Image:
+    # detailed enough that blurring it with different arguments differs
+    return Image.merge(
+        "RGB",
+        (
+            Image.linear_gradient("L").resize((800, 600)),
+            Image.radial_gradient("L").resize((800, 600)),
+            Image.linear_gradient("L").rotate(90).resize((800, 600)),
+        ),
+    )
+
+
+def test_effect_chain_resizes_with_each_stages_own_size() -> None:
+    effect_chain = postprocessing.EffectChain(
+        "test",
+        [
+            {"effect": "resize", "size": (400, 300)},
+            {"effect": "gaussian_blur", "offsets": (0, 0, 0, 0), "radius": 2},
+            {"effect": "resize", "size": (200, 100)},
+        ],
+    )
+
+    image = _make_image()
+    sizes = []
+    for _, apply_stage in effect_chain.plan(has_alpha=False):
+        image = apply_stage(image)
+        sizes.append(image.size)
+
+    assert sizes == [(400, 300), (400, 300), (200, 100)]
+
+
+def test_effect_chain_blurs_with_each_stages_own_arguments() -> None:
+    effect_chain = postprocessing.EffectChain(
+        "test",
+        [
+            {"effect": "gaussian_blur", "offsets": (0, 0, 0, 0), "radius": 8},
+            {"effect": "gaussian_blur", "offsets": (100, 100, 100, 100), "radius": 1},
+        ],
+    )
+
+    image = _make_image()
+    expected = postprocessing.apply_gaussian_blur(image, (0, 0, 0, 0), 8)
+    expected = postprocessing.apply_gaussian_blur(expected, (100, 100, 100, 100), 1)
+
+    actual = effect_chain.apply_with_timings(image)[0]
+
+    assert ImageChops.difference(actual, expected).getbbox() is None
@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+from app.adapters import aws_s3
+from app.usecases import postprocessing
+from app.usecases import scorewatch
+
+
+def test_upload_thumbnail_retries_failed_uploads(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    upload_results = [False, True]
+    uploaded_keys: list[str] = []
+
+    async def save_object_data(key: str, data: bytes) -> bool:
+        uploaded_keys.append(key)
+        return upload_results.pop(0)
+
+    monkeypatch.setattr(aws_s3, "save_object_data", save_object_data)
+
+    encoded_images: postprocessing.EncodedImages = {
+        "image_data": b"thumbnail",
+        "preview_image_data": b"preview",
+    }
+
+    async def upload_thumbnail_three_times() -> None:
+        for _ in range(3):
+            await scorewatch._upload_thumbnail(
+                "/scorewatch/thumbnails/1_2_score.png",
+                "cache-key",
+                encoded_images,
+            )
+
+    asyncio.run(upload_thumbnail_three_times())
+
+    # the failed upload is retried, and only the successful one is skipped after
+    assert uploaded_keys == ["/scorewatch/thumbnails/1_2_score.png"] * 2